@@ -10,3 +10,15 @@ background_worker = Celery('tasks')
 background_worker.config_from_object('django.conf:settings', namespace='CELERY')
 
 background_worker.autodiscover_tasks()
+
+# Очереди (см. CELERY_TASK_ROUTES) и воркеры для них:
+#
+#   interactive - обновления, запущенные пользователем со страницы:
+#     celery -A notes worker -Q interactive -c 4
+#   vk - загрузка друзей и списков треков, частота ограничена RATE_LIMITS:
+#     celery -A notes worker -Q vk -P threads -c 8
+#   providers - поиск жанров, почти всё время ждёт ответа сервисов:
+#     celery -A notes worker -Q providers -P threads -c 32 \
+#         --prefetch-multiplier 4
+#   db - запись в бд, по одной задаче на процесс:
+#     celery -A notes worker -Q db -c 4 -O fair
@@ -145,6 +145,25 @@ USE_L10N = True
 USE_TZ = True
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # графики bokeh, при переполнении вытесняются давно не использованные
+    'charts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'charts',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
@@ -154,3 +173,107 @@ STATIC_URL = '/static/'
 REDIS_SERVER = 'redis://localhost:6379/0'
 CELERY_BROKER_URL = REDIS_SERVER
 CELERY_RESULT_BACKEND = REDIS_SERVER
+# задачи разделены по очередям, чтобы медленный поиск жанров не задерживал
+# обновление пользователей, запуск воркеров описан в notes/celery.py
+CELERY_TASK_DEFAULT_QUEUE = 'db'
+CELERY_TASK_ROUTES = {
+    'vk_audio_stats.tasks.db_update_user': {'queue': 'vk'},
+    'vk_audio_stats.tasks.vk_fetch_track_lists': {'queue': 'vk'},
+    'vk_audio_stats.tasks.db_drain_genre_lookups': {'queue': 'providers'},
+    'vk_audio_stats.tasks.*': {'queue': 'db'},
+}
+# воркеры бд берут по одной задаче, воркер поиска жанров переопределяет
+# это при запуске
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ACKS_LATE = True
+CELERY_BEAT_SCHEDULE = {
+    # страховка: разбирает треки, оставшиеся в очереди поиска жанров после
+    # исчерпания повторов задач
+    'genre-lookups-drain': {
+        'task': 'vk_audio_stats.tasks.db_drain_genre_lookups',
+        'schedule': 5 * 60,
+    },
+    'recommendations-rebuild-matrix': {
+        'task': 'vk_audio_stats.tasks.recommendations_rebuild_matrix',
+        'schedule': 60 * 60,
+    },
+}
+
+# vk_audio_stats settings
+# время жизни (в секундах) найденного жанра трека в кеше и результата
+# "жанр не найден"
+GENRE_CACHE_TTL = 30 * 24 * 60 * 60
+GENRE_CACHE_NEGATIVE_TTL = 3 * 24 * 60 * 60
+
+# 'track' - жанр ищется для каждого трека отдельно,
+# 'artist' - один раз для исполнителя и проставляется всем его трекам
+GENRE_RESOLUTION = 'track'
+
+# параллельный опрос провайдеров жанров и время ожидания (в секундах)
+# ответа каждого из них, None - ждать без ограничения
+GENRE_LOOKUP_CONCURRENT = False
+GENRE_PROVIDER_TIMEOUTS = {
+    'discogs': 15,
+    'musicbrainz': 15,
+    'google': 15,
+}
+# сколько потоков одного воркера ищут жанры одновременно, должно быть не
+# меньше числа потоков воркера очереди providers (-c, см. notes/celery.py)
+GENRE_LOOKUP_THREADS = 32
+
+# ограничения частоты запросов к внешним сервисам, общие для всех воркеров:
+# rate - запросов в секунду, burst - сколько запросов можно сделать подряд
+RATE_LIMITS = {
+    'discogs': {'rate': 1, 'burst': 1},
+    'musicbrainz': {'rate': 1, 'burst': 1},
+    'google': {'rate': 1, 'burst': 1},
+    'vk': {'rate': 3, 'burst': 3},
+}
+
+# методы api vk, вызовы которых собираются в пачки по 25 и отправляются
+# одним запросом execute, например ('users.get', 'friends.get', 'audio.get'),
+# и сколько секунд ждать заполнения пачки из одновременных вызовов разных
+# потоков. С audio.get списки треков друзей загружаются пачками по 25 в
+# одной задаче
+VK_BATCH_METHODS = ()
+VK_BATCH_DELAY = 0.05
+
+# время жизни (в секундах) закешированных рекомендаций пользователя
+RECOMMENDATIONS_CACHE_TTL = 60 * 60
+
+# пользователей на странице жанров и в одном запросе при выгрузке
+GENRE_USERS_PAGE_SIZE = 50
+GENRE_EXPORT_PAGE_SIZE = 1000
+
+# кеш страницы жанров, также сбрасывается при изменении статистики жанров
+GENRE_STATS_CACHE_TTL = 60 * 60
+
+# кеш, в котором хранятся построенные графики
+CHART_CACHE = 'charts'
+
+# сколько жанров и друзей показывать на графиках, остальные жанры
+# объединяются в "другие"
+CHART_TOP_GENRES = 12
+CHART_TOP_FRIENDS = 30
+
+# по сколько треков из очереди поиска жанров берёт одна задача, через
+# сколько секунд повторяется поиск после ошибки или таймаута провайдеров и
+# после скольких неудачных попыток трек убирается из очереди
+GENRE_LOOKUP_CHUNK_SIZE = 50
+GENRE_LOOKUP_RETRY_DELAY = 60
+GENRE_LOOKUP_MAX_ATTEMPTS = 5
+
+# повторный запрос обновления пользователя или загрузки его треков в
+# течение REFRESH_FRESHNESS секунд после предыдущего присоединяется к нему,
+# а незавершённое обновление считается зависшим через REFRESH_TIMEOUT секунд
+REFRESH_FRESHNESS = 10 * 60
+REFRESH_TIMEOUT = 60 * 60
+# как часто обновление, дожидающееся списков треков, загружаемых другими
+# обновлениями, проверяет, сохранены ли они
+REFRESH_WAIT_INTERVAL = 5
+
+# сколько хранятся в redis списки треков и друзей, переданные задачам
+PAYLOAD_TTL = 6 * 60 * 60
+
+# сколько секунд long-poll запрос хода обновления ждёт изменений
+UPDATE_PROGRESS_POLL_TIMEOUT = 25
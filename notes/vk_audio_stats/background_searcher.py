@@ -1,5 +1,9 @@
+import json
+import logging
 import requests
+import threading
 import time
+from concurrent import futures
 
 import discogs_client
 import musicbrainzngs
@@ -10,25 +14,82 @@ from vk_api.audio import VkAudio
 from vk_api.exceptions import AccessDenied
 
 
-def lockable(lock_name=None):
-    def decorator(func):
-        nonlocal lock_name
-        if not lock_name:
-            lock_name = ''.join([func.__name__, '_lock'])
+logger = logging.getLogger(__name__)
+
+# Token bucket в redis. Запрос всегда забирает токен, даже если их не
+# осталось (количество уходит в минус), и получает время, которое нужно
+# подождать. Так воркеры обслуживаются в порядке обращения и делят квоту
+# провайдера поровну.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+
+tokens = math.min(burst, tokens + (now - last) * rate) - 1
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+
+if tokens < 0 then
+    return tostring(-tokens / rate)
+end
+return '0'
+"""
 
-        lock = REDIS_CLIENT.lock(lock_name)
 
-        def wrapper(*args, **kwargs):
-            with lock:
-                res = func(*args, **kwargs)
+class RateLimiter:
+    def __init__(self, name, rate, burst=1, client=None):
+        self._key = f'rate limit {name}'
+        self._rate = rate
+        self._burst = burst
+        self._script = (client or REDIS_CLIENT).register_script(
+            TOKEN_BUCKET_SCRIPT)
 
-            return res
+    def acquire(self):
+        wait = float(self._script(keys=[self._key],
+                                  args=[self._rate, self._burst]))
+        if wait > 0:
+            time.sleep(wait)
+
+
+def rate_limited(bucket):
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            self._limiter(bucket).acquire()
+            return func(self, *args, **kwargs)
 
         return wrapper
 
     return decorator
 
 
+class RateLimited:
+    """
+    Ограничение частоты запросов к провайдерам, общее для всех воркеров.
+
+    rate_limits - {провайдер: {'rate': запросов в секунду, 'burst': запас}}
+    дополняет и переопределяет RATE_LIMITS класса.
+    """
+    RATE_LIMITS = {}
+
+    def __init__(self, *args, rate_limits=None, **kwargs):
+        limits = dict(self.RATE_LIMITS, **(rate_limits or {}))
+        self._limiters = {name: RateLimiter(name, **limit)
+                          for name, limit in limits.items()}
+
+        super().__init__(*args, **kwargs)
+
+    def _limiter(self, bucket):
+        return self._limiters[bucket]
+
 
 class Singleton(type):
     _instance = {}
@@ -38,8 +99,65 @@ class Singleton(type):
         return cls._instance[cls]
 
 
+class GenreCache:
+    """
+    Общий для всех воркеров кеш результатов поиска жанров в redis.
+
+    Ключ - нормализованная пара (исполнитель, трек), значение - найденный
+    жанр и провайдер, который его вернул. Отрицательный результат (жанр не
+    найден) тоже кешируется, но на меньшее время.
+    """
+    HITS_KEY = 'genre cache hits'
+    MISSES_KEY = 'genre cache misses'
+
+    def __init__(self, ttl, negative_ttl, client=None):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._client = client or REDIS_CLIENT
+
+    @staticmethod
+    def normalize(value):
+        return ' '.join(value.lower().split())
+
+    def _key(self, artist, track=None):
+        # без трека ключ относится к жанру исполнителя целиком
+        pair = [self.normalize(artist)]
+        if track is not None:
+            pair.append(self.normalize(track))
+        return f'genre cache {json.dumps(pair, ensure_ascii=False)}'
+
+    def get(self, artist, track=None):
+        value = self._client.get(self._key(artist, track))
+        self._client.incr(self.MISSES_KEY if value is None else self.HITS_KEY)
+
+        return json.loads(value) if value is not None else None
+
+    def peek(self, artist, track=None):
+        """Как get, но не учитывается в статистике попаданий."""
+        value = self._client.get(self._key(artist, track))
+        return json.loads(value) if value is not None else None
+
+    def set(self, artist, track, genre, provider=None):
+        # track=None - жанр исполнителя
+        self._client.set(self._key(artist, track),
+                         json.dumps({'genre': genre, 'provider': provider}),
+                         ex=self._ttl if genre else self._negative_ttl)
+
+    def stats(self):
+        hits, misses = self._client.mget(self.HITS_KEY, self.MISSES_KEY)
+        return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+
+class ProviderTimeout(Exception):
+    pass
+
+
 class TagFinder(metaclass=Singleton):
-    def __init__(self, discogs_creds):
+    # провайдеры в порядке приоритета
+    PROVIDERS = ('discogs', 'musicbrainz', 'google')
+
+    def __init__(self, discogs_creds, cache=None, concurrent=False,
+                 timeouts=None, callers=1):
         self._dgs = discogs_client.Client(
             discogs_creds['app_name'], user_token=discogs_creds['token'])
         musicbrainzngs.set_useragent('MyTagFinderApp', '0.01')
@@ -49,12 +167,16 @@ class TagFinder(metaclass=Singleton):
                               'Chrome/61.0.3163.100 Safari/537.36'
             }
 
-        self._google_last_time = 0
-        self._discogs_last_time = 0
+        self._cache = cache
 
-    def _wait(self, last, rate):
-        if time.time() - last < 1 / rate:
-            time.sleep(1 / rate - (time.time() - last))
+        # в параллельном режиме провайдеры опрашиваются одновременно,
+        # timeouts - время ожидания ответа каждого провайдера в секундах.
+        # Экземпляр один на процесс, callers - сколько потоков процесса
+        # ищут жанры одновременно, у каждого свой поток на провайдера
+        self._executor = (futures.ThreadPoolExecutor(
+            max_workers=callers * len(self.PROVIDERS))
+            if concurrent else None)
+        self._timeouts = timeouts or {}
 
     def _musicbrainz(self, artist, track):
         res = sorted(
@@ -76,29 +198,45 @@ class TagFinder(metaclass=Singleton):
                               key=lambda x: int(x['ext:score']))[-1]['name']
 
         artist_id = res[0]['artist-credit'][0]['artist']['id']
-        a = musicbrainzngs.get_artist_by_id(id=artist_id, includes=['tags'])
+
+        return self._musicbrainz_artist_tag(artist_id)
+
+    def _musicbrainz_artist_tag(self, artist_id):
+        a = musicbrainzngs.get_artist_by_id(
+            id=artist_id, includes=['tags'])['artist']
 
         if 'tag-list' not in a:
             return None
 
-        return sorted(a['tag-list'],
-                      key=lambda x: int(x['ext:score']))[-1]['name']
+        return sorted(a['tag-list'], key=lambda x: int(x['count']))[-1]['name']
 
-    def _discogs(self, artist, track):
-        self._wait(self._google_last_time, 1)
+    def _musicbrainz_artist(self, artist):
+        res = musicbrainzngs.search_artists(
+            artist=artist, limit=1, strict=True)['artist-list']
+
+        if not res:
+            return None
+
+        if 'tag-list' in res[0]:
+            return sorted(res[0]['tag-list'],
+                          key=lambda x: int(x['count']))[-1]['name']
 
+        return self._musicbrainz_artist_tag(res[0]['id'])
+
+    def _discogs(self, artist, track):
         res = self._dgs.search('*', type='release', artist=artist, track=track)
 
-        self._discogs_last_time = time.time()
+        return (res[0].styles or res[0].genres)[0] if res else None
+
+    def _discogs_artist(self, artist):
+        res = self._dgs.search('*', type='release', artist=artist)
 
         return (res[0].styles or res[0].genres)[0] if res else None
 
     def _google(self, artist, track):
-        query = (' '.join([artist, track, 'genre'])
+        query = (' '.join(filter(None, [artist, track, 'genre']))
                  .replace(' ', '+').replace('/', '%2F'))
 
-        self._wait(self._google_last_time, 1)
-
         url = f'https://www.google.com/search?q={query}&num=1&hl=en'
         # TODO: ??? ('Connection aborted.', OSError(107, 'Transport endpoint is not connected'))
         try:
@@ -107,8 +245,6 @@ class TagFinder(metaclass=Singleton):
             print(f'error: {ex} while trying url {url}')
             return None
 
-        self._google_last_time = time.time()
-
         soup = BeautifulSoup(response.text, 'lxml')
 
         # рандомные названия классов в html, поэтому такая фигня
@@ -124,14 +260,228 @@ class TagFinder(metaclass=Singleton):
 
         return genre_tag.string.lower()
 
-    def find(self, artist, track):
-        return (self._discogs(artist, track) or
-                self._musicbrainz(artist, track) or
-                self._google(artist, track))
+    def _google_artist(self, artist):
+        return self._google(artist, None)
+
+    def _acquire(self, provider):
+        """Ждёт, пока можно будет отправить запрос провайдеру."""
+        pass
+
+    def _provider(self, provider, track=None):
+        if track is None:
+            return getattr(self, f'_{provider}_artist')
+        return getattr(self, f'_{provider}')
+
+    def _request_after_token(self, provider, func, args, started, done):
+        """
+        Запрос к провайдеру в потоке пула: ждёт разрешения на запрос и
+        запоминает время его получения в started[provider].
+        """
+        granted = started[provider]
+        try:
+            # ответ уже получен от более приоритетного провайдера
+            if done.is_set():
+                return None
+            self._acquire(provider)
+        finally:
+            granted.time = time.time()
+            granted.set()
+
+        return func(*args)
+
+    def _lookup_concurrent(self, artist, track=None):
+        args = (artist,) if track is None else (artist, track)
+
+        # разрешение на запрос ожидается в потоке пула, а время ожидания
+        # провайдера считается с момента его получения
+        started = {p: threading.Event() for p in self.PROVIDERS}
+        done = threading.Event()
+        pending = [
+            (p, self._executor.submit(self._request_after_token, p,
+                                      self._provider(p, track), args,
+                                      started, done))
+            for p in self.PROVIDERS]
+
+        timed_out = []
+        for i, (provider, future) in enumerate(pending):
+            timeout = self._timeouts.get(provider)
+            if timeout is not None:
+                started[provider].wait()
+                timeout = max(0, started[provider].time + timeout
+                              - time.time())
+
+            try:
+                genre = future.result(timeout=timeout)
+            except futures.TimeoutError:
+                timed_out.append(provider)
+                continue
+
+            if genre:
+                # ответы менее приоритетных провайдеров уже не нужны
+                done.set()
+                for _, f in pending[i + 1:]:
+                    f.cancel()
+                return genre, provider
+
+        if timed_out:
+            raise ProviderTimeout(
+                f'{artist} - {track}: нет ответа от {", ".join(timed_out)}')
+
+        return None, None
+
+    def lookup(self, artist, track=None):
+        """
+        Опрашивает провайдеров в порядке приоритета, возвращает пару
+        (жанр, провайдер). Без трека ищется жанр исполнителя.
+        """
+        if self._executor is not None:
+            return self._lookup_concurrent(artist, track)
+
+        for provider in self.PROVIDERS:
+            args = (artist,) if track is None else (artist, track)
+            self._acquire(provider)
+            genre = self._provider(provider, track)(*args)
+            if genre:
+                return genre, provider
+
+        return None, None
+
+    def find(self, artist, track=None):
+        if self._cache is None:
+            return self.lookup(artist, track)[0]
+
+        cached = self._cache.get(artist, track)
+        if cached is not None:
+            return cached['genre']
+
+        genre, provider = self.lookup(artist, track)
+        self._cache.set(artist, track, genre, provider)
+
+        return genre
+
+    def find_artist(self, artist):
+        return self.find(artist)
+
+
+class VkExecuteError(Exception):
+    def __init__(self, method, params, error):
+        super().__init__(f'{method}({params}): {error}')
+        self.method = method
+        self.params = params
+        self.error = error
+
+
+class VkExecutePool:
+    """
+    Копит вызовы методов api vk и отправляет их одним запросом execute,
+    по MAX_CALLS штук. Запрос уходит, когда набралась полная пачка, или
+    через delay секунд после первого вызова в пачке.
+
+    execute(code) - функция, выполняющая запрос execute с кодом на VKScript
+    и возвращающая ответ целиком, вместе с execute_errors.
+    """
+    MAX_CALLS = 25
+
+    def __init__(self, execute, delay=0.05):
+        self._execute = execute
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+
+    @staticmethod
+    def code(calls):
+        return 'return [{}];'.format(','.join(
+            f'API.{method}({json.dumps(params, ensure_ascii=False)})'
+            for method, params in calls))
+
+    @staticmethod
+    def results(calls, response):
+        """
+        Результаты вызовов calls из ответа execute, VkExecuteError вместо
+        результата неудавшегося вызова.
+        """
+        # ошибки идут в том же порядке, что и неудавшиеся вызовы
+        errors = iter(response.get('execute_errors', []))
+        return [VkExecuteError(method, params, next(errors, None))
+                if result is False else result
+                for (method, params), result in zip(calls,
+                                                    response['response'])]
+
+    @classmethod
+    def execute_all(cls, execute, calls):
+        """
+        Выполняет все вызовы calls пачками по MAX_CALLS в одном потоке,
+        возвращает их результаты так же, как results.
+        """
+        calls = list(calls)
+        results = []
+        for i in range(0, len(calls), cls.MAX_CALLS):
+            batch = calls[i:i + cls.MAX_CALLS]
+            results.extend(cls.results(batch, execute(cls.code(batch))))
+
+        return results
+
+    def call(self, method, params):
+        future = futures.Future()
+
+        with self._lock:
+            self._pending.append((method, params, future))
+            if len(self._pending) >= self.MAX_CALLS:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch:
+            self._send(batch)
+
+        return future
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = self._take()
+            if not batch:
+                return
+            self._send(batch)
+
+    def _take(self):
+        batch = self._pending[:self.MAX_CALLS]
+        self._pending = self._pending[self.MAX_CALLS:]
+
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        return batch
+
+    def _send(self, batch):
+        try:
+            response = self._execute(
+                self.code((method, params) for method, params, _ in batch))
+        except Exception as ex:
+            for *_, future in batch:
+                future.set_exception(ex)
+            return
+
+        results = self.results(
+            [(method, params) for method, params, _ in batch], response)
+        for (*_, future), result in zip(batch, results):
+            if isinstance(result, VkExecuteError):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
 
 class VkApi(metaclass=Singleton):
-    def __init__(self, credentials):
+    # сколько id принимает один вызов users.get
+    USERS_PER_CALL = 1000
+
+    def __init__(self, credentials, batch_methods=(), batch_delay=0.05):
         self._session = vk_api.VkApi(login=credentials['login'],
                                      password=credentials['password'],
                                      token=credentials['token'])
@@ -142,53 +492,124 @@ class VkApi(metaclass=Singleton):
             print(e)
 
         self._audio = VkAudio(self._session)
-        self._api = self._session.get_api()
+
+        # методы из batch_methods отправляются пачками через execute
+        self._batch_methods = set(batch_methods)
+        self._pool = (VkExecutePool(self._execute, batch_delay)
+                      if self._batch_methods else None)
+
+    def _request(self, method, params):
+        return self._session.method(method, params)
+
+    def _execute(self, code):
+        return self._session.method('execute', {'code': code}, raw=True)
+
+    def _audio_list(self, id):
+        return list(self._audio.get(owner_id=id))
+
+    def _method(self, method, **params):
+        if method in self._batch_methods:
+            return self._pool.call(method, params).result()
+        return self._request(method, params)
 
     def friends(self, id):
-        friend_list = self._api.friends.get(user_id=id, fields=['name'])
+        friend_list = self._method('friends.get', user_id=id, fields='name')
         return {u['id']: ' '.join([u['first_name'], u['last_name']])
                 for u in friend_list['items'] if 'deactivated' not in u}
 
     def username(self, id):
-        user = self._api.users.get(user_ids=id)[0]
-        return ' '.join([user['first_name'], user['last_name']])
+        # vk возвращает id числом, а id может прийти строкой из формы
+        return self.usernames([id])[int(id)]
+
+    def usernames(self, ids):
+        """Имена пользователей {id: имя}, users.get по USERS_PER_CALL id."""
+        ids = list(ids)
+        names = {}
+        for i in range(0, len(ids), self.USERS_PER_CALL):
+            users = self._method(
+                'users.get',
+                user_ids=','.join(map(str, ids[i:i + self.USERS_PER_CALL])))
+            names.update({u['id']: ' '.join([u['first_name'], u['last_name']])
+                          for u in users})
+
+        return names
 
     def track_list(self, id):
-        try:
-            tracklist = [(t['artist'].lower(), t['title'].lower())
-                         for t in self._audio.get(owner_id=id)]
-        except AccessDenied:
-            tracklist = []
-
-        return tracklist
+        return self.track_lists([id])[id]
+
+    def track_lists(self, ids):
+        """
+        Списки треков пользователей {id: [(исполнитель, трек)]}. Если
+        audio.get есть в batch_methods, списки загружаются через api пачками
+        execute по VkExecutePool.MAX_CALLS за один вызов, иначе или при
+        ошибке вызова - через VkAudio по одному.
+        """
+        ids = list(ids)
+        audio = dict.fromkeys(ids)
+        if 'audio.get' in self._batch_methods:
+            results = VkExecutePool.execute_all(
+                self._execute,
+                [('audio.get', {'owner_id': id, 'count': 6000})
+                 for id in ids])
+            for id, result in zip(ids, results):
+                if isinstance(result, VkExecuteError):
+                    # нет доступа к audio.get через api
+                    logger.warning(f'{result}, загрузка через VkAudio')
+                else:
+                    audio[id] = result['items']
+
+        track_lists = {}
+        for id in ids:
+            try:
+                track_lists[id] = [
+                    (t['artist'].lower(), t['title'].lower())
+                    for t in (audio[id] if audio[id] is not None
+                              else self._audio_list(id))]
+            except AccessDenied:
+                track_lists[id] = []
+
+        return track_lists
 
 
 
 REDIS_CLIENT = redis.Redis()
 
 
-class TagFinderLockable(TagFinder):
-    @lockable()
-    def _musicbrainz(self, *args, **kwargs):
-        return super()._musicbrainz(*args, **kwargs)
+class TagFinderLockable(RateLimited, TagFinder):
+    RATE_LIMITS = {
+        'discogs': {'rate': 1, 'burst': 1},
+        'musicbrainz': {'rate': 1, 'burst': 1},
+        'google': {'rate': 1, 'burst': 1},
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # частоту запросов к musicbrainz ограничивает RateLimiter
+        musicbrainzngs.set_rate_limit(False)
+
+    def _acquire(self, provider):
+        self._limiter(provider).acquire()
+
+    # дополнительный запрос тегов исполнителя внутри поиска musicbrainz
+    @rate_limited('musicbrainz')
+    def _musicbrainz_artist_tag(self, *args, **kwargs):
+        return super()._musicbrainz_artist_tag(*args, **kwargs)
 
-    @lockable()
-    def _discogs(self, *args, **kwargs):
-        return super()._discogs(*args, **kwargs)
 
-    @lockable()
-    def _google(self, *args, **kwargs):
-        return super()._google(*args, **kwargs)
+class VkApiLockable(RateLimited, VkApi):
+    RATE_LIMITS = {
+        'vk': {'rate': 3, 'burst': 3},
+    }
 
-class VkApiLockable(VkApi):
-    @lockable('vk_lock')
-    def friends(self, *args, **kwargs):
-        return super().friends(*args, **kwargs)
+    # ограничивается каждый http запрос, пачка execute считается за один
+    @rate_limited('vk')
+    def _request(self, *args, **kwargs):
+        return super()._request(*args, **kwargs)
 
-    @lockable('vk_lock')
-    def username(self, *args, **kwargs):
-        return super().username(*args, **kwargs)
+    @rate_limited('vk')
+    def _execute(self, *args, **kwargs):
+        return super()._execute(*args, **kwargs)
 
-    @lockable('vk_lock')
-    def track_list(self, *args, **kwargs):
-        return super().track_list(*args, **kwargs)
+    @rate_limited('vk')
+    def _audio_list(self, *args, **kwargs):
+        return super()._audio_list(*args, **kwargs)
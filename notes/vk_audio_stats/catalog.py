@@ -0,0 +1,223 @@
+"""
+Массовое сохранение каталога исполнителей и треков, треков пользователей
+и статистики жанров пользователей.
+"""
+
+import hashlib
+import json
+
+from django.db import connections, router, transaction
+
+from .models import Artist, Track, UserGenreStats, VkUser
+
+
+ARTIST_NAME_LENGTH = Artist._meta.get_field('name').max_length
+TRACK_TITLE_LENGTH = Track._meta.get_field('title').max_length
+
+# по сколько id загружать во временную таблицу за один запрос
+CHUNK_SIZE = 5000
+
+
+def chunks(items, size):
+    items = list(items)
+    return (items[i:i + size] for i in range(0, len(items), size))
+
+
+def valid_pairs(track_list):
+    return {(a, t) for a, t in track_list
+            if len(a) <= ARTIST_NAME_LENGTH and len(t) <= TRACK_TITLE_LENGTH}
+
+
+def fingerprint(track_list):
+    """Хеш и количество треков списка, не зависящие от порядка и повторов."""
+    pairs = sorted(valid_pairs(track_list))
+    digest = hashlib.sha256(
+        json.dumps(pairs, ensure_ascii=False).encode()).hexdigest()
+
+    return digest, len(pairs)
+
+
+def upsert_catalog(track_list):
+    """
+    Добавляет в бд недостающих исполнителей и треки из списка пар
+    (исполнитель, трек). Количество запросов не зависит от длины списка.
+
+    Возвращает словарь {(исполнитель, трек): id трека} и список добавленных
+    пар.
+    """
+    pairs = valid_pairs(track_list)
+    artists = {a for a, _ in pairs}
+
+    Artist.objects.bulk_create((Artist(name=a) for a in artists),
+                               ignore_conflicts=True)
+    artist_ids = dict(Artist.objects.filter(name__in=artists)
+                      .values_list('name', 'id'))
+    artist_names = {i: name for name, i in artist_ids.items()}
+
+    def select_track_ids(pairs):
+        tracks = (Track.objects
+                  .filter(artist_id__in={artist_ids[a] for a, _ in pairs},
+                          title__in={t for _, t in pairs})
+                  .values_list('artist_id', 'title', 'id'))
+        return {(artist_names[a], t): i for a, t, i in tracks
+                if (artist_names[a], t) in pairs}
+
+    track_ids = select_track_ids(pairs)
+
+    # треки, добавленные параллельно другой задачей, пропускаются
+    # благодаря уникальности (исполнитель, название)
+    new_pairs = [p for p in pairs if p not in track_ids]
+    if new_pairs:
+        Track.objects.bulk_create(
+            (Track(title=t, artist_id=artist_ids[a]) for a, t in new_pairs),
+            ignore_conflicts=True)
+        track_ids.update(select_track_ids(set(new_pairs)))
+
+    return track_ids, new_pairs
+
+
+def _add_user_genre_counts(cursor, rows_sql, params):
+    """
+    Прибавляет к UserGenreStats строки (пользователь, жанр, изменение),
+    которые возвращает запрос rows_sql, и удаляет обнулившиеся записи.
+
+    rows_sql должен возвращать строки, упорядоченные по пользователю и
+    жанру: тогда одновременные транзакции блокируют записи статистики в
+    одном порядке и не могут взаимно заблокировать друг друга.
+    """
+    table = UserGenreStats._meta.db_table
+
+    cursor.execute(f'INSERT INTO {table} (user_id, genre_id, count) '
+                   f'{rows_sql} '
+                   f'ON CONFLICT (user_id, genre_id) DO UPDATE '
+                   f'SET count = {table}.count + EXCLUDED.count '
+                   f'RETURNING user_id, genre_id', params)
+    changed = cursor.fetchall()
+
+    if changed:
+        cursor.execute(f'DELETE FROM {table} '
+                       f'WHERE (user_id, genre_id) IN ('
+                       f'  SELECT * FROM unnest(%s::integer[], %s::integer[])'
+                       f') AND count <= 0',
+                       [[u for u, _ in changed], [g for _, g in changed]])
+
+    return {u for u, _ in changed}
+
+
+def sync_user_tracks(user_id, track_ids):
+    """
+    Приводит треки пользователя в соответствие с track_ids.
+
+    id треков порциями загружаются во временную таблицу, затем лишние связи
+    пользователя с треками удаляются, а недостающие добавляются, каждое
+    одним запросом. Статистика жанров пользователя обновляется в той же
+    транзакции. Возвращает количество добавленных и удалённых треков.
+
+    Добавленные и удалённые треки блокируются от смены жанра
+    (set_tracks_genre) до чтения их жанров. Иначе трек, жанр которого
+    меняется одновременно, не был бы учтён ни одной из транзакций: каждая
+    не видит незафиксированных изменений другой.
+    """
+    through = VkUser.tracks.through
+    table = through._meta.db_table
+    track_table = Track._meta.db_table
+    db = router.db_for_write(through)
+
+    # изменение статистики жанров по списку добавленных/удалённых треков
+    genre_counts_sql = (f'SELECT %s, genre_id, %s * count(*) '
+                        f'FROM {track_table} '
+                        f'WHERE id = ANY(%s) AND genre_id IS NOT NULL '
+                        f'GROUP BY genre_id ORDER BY genre_id')
+
+    with transaction.atomic(using=db), connections[db].cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS incoming_tracks '
+                       '(track_id integer PRIMARY KEY) ON COMMIT DROP')
+        cursor.execute('TRUNCATE incoming_tracks')
+
+        for chunk in chunks(track_ids, CHUNK_SIZE):
+            cursor.execute('INSERT INTO incoming_tracks '
+                           'SELECT unnest(%s::integer[]) '
+                           'ON CONFLICT DO NOTHING', [chunk])
+
+        cursor.execute(f'DELETE FROM {table} m '
+                       f'WHERE m.vkuser_id = %s AND NOT EXISTS ('
+                       f'  SELECT 1 FROM incoming_tracks i '
+                       f'  WHERE i.track_id = m.track_id) '
+                       f'RETURNING m.track_id', [user_id])
+        removed = [r[0] for r in cursor.fetchall()]
+
+        cursor.execute(f'INSERT INTO {table} (vkuser_id, track_id) '
+                       f'SELECT %s, i.track_id FROM incoming_tracks i '
+                       f'WHERE NOT EXISTS ('
+                       f'  SELECT 1 FROM {table} m '
+                       f'  WHERE m.vkuser_id = %s '
+                       f'    AND m.track_id = i.track_id) '
+                       f'RETURNING track_id', [user_id, user_id])
+        added = [r[0] for r in cursor.fetchall()]
+
+        if removed or added:
+            cursor.execute(f'SELECT id FROM {track_table} '
+                           f'WHERE id = ANY(%s) ORDER BY id FOR SHARE',
+                           [removed + added])
+
+        if removed:
+            _add_user_genre_counts(cursor, genre_counts_sql,
+                                   [user_id, -1, removed])
+        if added:
+            _add_user_genre_counts(cursor, genre_counts_sql,
+                                   [user_id, 1, added])
+
+    return len(added), len(removed)
+
+
+def set_tracks_genre(tracks, genre):
+    """
+    Проставляет жанр трекам из queryset tracks и переносит их в
+    статистике жанров всех пользователей, у которых они есть.
+    Возвращает количество изменённых треков и id затронутых пользователей.
+    """
+    through_table = VkUser.tracks.through._meta.db_table
+    db = router.db_for_write(Track)
+
+    with transaction.atomic(using=db), connections[db].cursor() as cursor:
+        changed = list(tracks.exclude(genre=genre).order_by('id')
+                       .select_for_update(of=('self',))
+                       .values_list('id', 'genre_id'))
+        if not changed:
+            return 0, set()
+
+        Track.objects.filter(id__in=[i for i, _ in changed]).update(
+            genre=genre)
+
+        # трек прибавляется к новому жанру и вычитается из старого
+        deltas = [(i, genre.id, 1) for i, _ in changed]
+        deltas.extend((i, old, -1) for i, old in changed if old is not None)
+
+        users = _add_user_genre_counts(
+            cursor,
+            f'SELECT m.vkuser_id, d.genre_id, sum(d.delta) '
+            f'FROM unnest(%s::integer[], %s::integer[], %s::integer[]) '
+            f'  AS d(track_id, genre_id, delta) '
+            f'JOIN {through_table} m ON m.track_id = d.track_id '
+            f'GROUP BY m.vkuser_id, d.genre_id '
+            f'ORDER BY m.vkuser_id, d.genre_id',
+            [list(column) for column in zip(*deltas)])
+
+    return len(changed), users
+
+
+def rebuild_user_genre_stats():
+    """Пересчитывает статистику жанров всех пользователей с нуля."""
+    table = UserGenreStats._meta.db_table
+    through_table = VkUser.tracks.through._meta.db_table
+    track_table = Track._meta.db_table
+    db = router.db_for_write(UserGenreStats)
+
+    with transaction.atomic(using=db), connections[db].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table}')
+        cursor.execute(f'INSERT INTO {table} (user_id, genre_id, count) '
+                       f'SELECT m.vkuser_id, t.genre_id, count(*) '
+                       f'FROM {through_table} m '
+                       f'JOIN {track_table} t ON t.id = m.track_id '
+                       f'WHERE t.genre_id IS NOT NULL '
+                       f'GROUP BY m.vkuser_id, t.genre_id')
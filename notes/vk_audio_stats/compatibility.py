@@ -0,0 +1,117 @@
+"""
+Музыкальная совместимость пользователя с друзьями.
+
+Статистика жанров пользователя и всех его друзей загружается одним
+запросом в матрицу пользователи × жанры, по которой сразу для всех друзей
+считаются общие жанры и совместимость.
+"""
+
+from collections import Counter
+
+import numpy as np
+from django.db.models import Count
+
+from .models import UserGenreStats, VkUser
+from .similarity import track_overlap
+
+
+def user_labels(users):
+    """Имена пользователей для графиков, одинаковые имена дополняются id."""
+    names = Counter(u.name for u in users)
+    return [u.name if names[u.name] == 1 else f'{u.name} ({u.vk_id})'
+            for u in users]
+
+
+class GenreMatrix:
+    """
+    counts[i, j] - количество треков жанра genres[j] у пользователя users[i],
+    track_counts[i] - общее количество треков пользователя, sketches[i] -
+    MinHash-скетч его треков. Первая строка - сам пользователь, остальные -
+    его друзья.
+    """
+
+    def __init__(self, users, genres, counts, track_counts, sketches=None):
+        self.users = users
+        self.labels = user_labels(users)
+        self.genres = genres
+        self.counts = np.asarray(counts)
+        self.track_counts = np.asarray(track_counts)
+        self.sketches = sketches or [None] * len(users)
+
+    @classmethod
+    def load(cls, user, friends):
+        users = [user, *friends]
+        index = {u.id: i for i, u in enumerate(users)}
+
+        stats = list(UserGenreStats.objects
+                     .filter(user_id__in=index, count__gt=0)
+                     .values_list('user_id', 'genre__name', 'count'))
+        genres = sorted({g for _, g, _ in stats})
+        genre_index = {g: j for j, g in enumerate(genres)}
+
+        counts = np.zeros((len(users), len(genres)), dtype=np.int64)
+        for user_id, genre, count in stats:
+            counts[index[user_id], genre_index[genre]] = count
+
+        track_counts = np.zeros(len(users), dtype=np.int64)
+        sketches = [None] * len(users)
+        for user_id, count, sketch in (
+                VkUser.objects.filter(id__in=index)
+                .annotate(track_count=Count('tracks'))
+                .values_list('id', 'track_count', 'track_sketch')):
+            track_counts[index[user_id]] = count
+            sketches[index[user_id]] = sketch
+
+        return cls(users, genres, counts, track_counts, sketches)
+
+    def _genre_dict(self, row):
+        return {self.genres[j]: int(row[j]) for j in np.flatnonzero(row)}
+
+    def user_genres(self):
+        return self._genre_dict(self.counts[0])
+
+    def common_for_all(self):
+        """Жанры, которые есть у всех: {жанр: [(имя, количество), ...]}."""
+        columns = np.flatnonzero((self.counts > 0).all(axis=0))
+        order = sorted(range(len(self.users)), key=lambda i: self.labels[i])
+
+        return {self.genres[j]: [(self.labels[i], int(self.counts[i, j]))
+                                 for i in order]
+                for j in columns}
+
+    def common(self):
+        """Общие с каждым из друзей жанры: {имя друга: {жанр: количество}}."""
+        common = np.minimum(self.counts[1:], self.counts[0])
+
+        return {self.labels[i + 1]: self._genre_dict(row)
+                for i, row in enumerate(common) if row.any()}
+
+    def friends_with_common(self):
+        """Друзья, у которых есть общие с пользователем жанры."""
+        common = np.minimum(self.counts[1:], self.counts[0]).any(axis=1)
+
+        return [self.users[i + 1] for i in np.flatnonzero(common)]
+
+    def compatibility(self):
+        """
+        Доля общих треков в процентах от большей из двух библиотек
+        для друзей, у которых есть общие жанры с пользователем.
+        """
+        common = np.minimum(self.counts[1:], self.counts[0]).sum(axis=1)
+        norm = np.maximum(self.track_counts[1:], self.track_counts[0])
+        scores = 100 * common / np.maximum(norm, 1)
+
+        return {self.labels[i + 1]: float(scores[i])
+                for i in np.flatnonzero(common)}
+
+    def track_overlap(self):
+        """
+        Оценка общих треков с каждым из друзей по скетчам:
+        {имя друга: (коэффициент Жаккара, количество общих треков)}.
+        """
+        return {
+            self.labels[i]: track_overlap(
+                self.sketches[0], int(self.track_counts[0]),
+                self.sketches[i], int(self.track_counts[i]))
+            for i in range(1, len(self.users))
+        }
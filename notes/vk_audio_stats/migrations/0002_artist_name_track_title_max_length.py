@@ -0,0 +1,25 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+# модели уже объявляли max_length=128, а 0001_initial создала поля с 64:
+# миграция только приводит схему в соответствие с моделями
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='artist',
+            name='name',
+            field=models.CharField(max_length=128, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='track',
+            name='title',
+            field=models.CharField(max_length=128),
+        ),
+    ]
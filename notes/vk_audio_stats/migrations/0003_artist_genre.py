@@ -0,0 +1,19 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0002_artist_name_track_title_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artist',
+            name='genre',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='vk_audio_stats.Genre'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+# одинаковые треки сливаются в трек с наименьшим id: ему переходят
+# пользователи дубликатов и, если у него нет жанра, жанр одного из них.
+# Внешние ключи в PostgreSQL создаются DEFERRABLE INITIALLY DEFERRED, и
+# отложенные проверки после изменения треков не дали бы выполнить
+# ALTER TABLE в AddConstraint в той же транзакции, поэтому они делаются
+# сразу.
+MERGE_DUPLICATE_TRACKS = [
+    """
+    SET CONSTRAINTS ALL IMMEDIATE
+    """,
+    """
+    CREATE TEMP TABLE track_duplicates AS
+    SELECT id, keep_id FROM (
+        SELECT id, min(id) OVER (PARTITION BY artist_id, title) AS keep_id
+        FROM vk_audio_stats_track
+    ) t
+    WHERE id <> keep_id
+    """,
+    """
+    UPDATE vk_audio_stats_track t
+    SET genre_id = g.genre_id
+    FROM (
+        SELECT d.keep_id, min(dt.genre_id) AS genre_id
+        FROM track_duplicates d
+        JOIN vk_audio_stats_track dt ON dt.id = d.id
+        WHERE dt.genre_id IS NOT NULL
+        GROUP BY d.keep_id
+    ) g
+    WHERE t.id = g.keep_id AND t.genre_id IS NULL
+    """,
+    """
+    INSERT INTO vk_audio_stats_vkuser_tracks (vkuser_id, track_id)
+    SELECT DISTINCT m.vkuser_id, d.keep_id
+    FROM vk_audio_stats_vkuser_tracks m
+    JOIN track_duplicates d ON d.id = m.track_id
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    DELETE FROM vk_audio_stats_vkuser_tracks m
+    USING track_duplicates d
+    WHERE m.track_id = d.id
+    """,
+    """
+    DELETE FROM vk_audio_stats_track t
+    USING track_duplicates d
+    WHERE t.id = d.id
+    """,
+    """
+    DROP TABLE track_duplicates
+    """,
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0003_artist_genre'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATE_TRACKS, migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name='track',
+            constraint=models.UniqueConstraint(fields=('artist', 'title'), name='track_unique_artist_title'),
+        ),
+    ]
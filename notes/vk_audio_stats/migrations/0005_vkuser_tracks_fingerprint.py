@@ -0,0 +1,28 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0004_track_unique_artist_title'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vkuser',
+            name='tracks_checked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vkuser',
+            name='tracks_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vkuser',
+            name='tracks_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+FILL_USER_GENRE_STATS = """
+    INSERT INTO vk_audio_stats_usergenrestats (user_id, genre_id, count)
+    SELECT m.vkuser_id, t.genre_id, count(*)
+    FROM vk_audio_stats_vkuser_tracks m
+    JOIN vk_audio_stats_track t ON t.id = m.track_id
+    WHERE t.genre_id IS NOT NULL
+    GROUP BY m.vkuser_id, t.genre_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0005_vkuser_tracks_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserGenreStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('genre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vk_audio_stats.Genre')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vk_audio_stats.VkUser')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usergenrestats',
+            constraint=models.UniqueConstraint(fields=('user', 'genre'), name='user_genre_stats_unique'),
+        ),
+        migrations.RunSQL(FILL_USER_GENRE_STATS, migrations.RunSQL.noop),
+    ]
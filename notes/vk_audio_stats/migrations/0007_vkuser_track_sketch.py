@@ -0,0 +1,21 @@
+# Generated by Django 2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vk_audio_stats', '0006_usergenrestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vkuser',
+            name='track_sketch',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        # сброс отпечатков, чтобы скетчи посчитались при следующем обновлении
+        migrations.RunSQL("UPDATE vk_audio_stats_vkuser SET tracks_hash = ''",
+                          migrations.RunSQL.noop),
+    ]
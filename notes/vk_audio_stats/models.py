@@ -2,10 +2,10 @@
 ┌──VkUser───┐        ┌──Track──────┐       ┌──Artist───┐
 │* id       │  ┌────►│* id         │  ┌───►│* id       │
 │  vk_id    │  │     │  title      │  │    │  name     │
-│  name     │  │     │  artist     │──┘    └───────────┘
-│  tracks   │──┘     │  genre      │────┐
-└───────────┘        │  subgenre   │    │  ┌──Genre────┐
-                     └─────────────┘    └─►│* id       │
+│  name     │  │     │  artist     │──┘    │  genre    │──┐
+│  tracks   │──┘     │  genre      │────┐  └───────────┘  │
+└───────────┘        │  subgenre   │    │  ┌──Genre────┐  │
+                     └─────────────┘    └─►│* id       │◄─┘
                                            │  name     │
                                            └───────────┘
 """
@@ -46,6 +46,8 @@ class Genre(models.Model):
 
 class Artist(models.Model):
     name = models.CharField(max_length=128, unique=True)
+    genre = models.ForeignKey(Genre, on_delete=models.DO_NOTHING,
+                              null=True, blank=True)
 
     def __str__(self):
         return str(self.name).title()
@@ -57,6 +59,12 @@ class Track(models.Model):
     genre = models.ForeignKey(Genre, on_delete=models.DO_NOTHING,
                               null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['artist', 'title'],
+                                    name='track_unique_artist_title'),
+        ]
+
     def __str__(self):
         return f'"{str(self.title).title()}" by {str(self.artist).title()} ' \
                f'({self.genre or "".title()})'
@@ -67,6 +75,32 @@ class VkUser(models.Model):
     name = models.CharField(max_length=64)
     tracks = models.ManyToManyField(Track)
     friends = models.ManyToManyField('self')
+    # отпечаток последнего сохранённого списка треков
+    tracks_hash = models.CharField(max_length=64, blank=True)
+    tracks_count = models.IntegerField(null=True, blank=True)
+    tracks_checked = models.DateTimeField(null=True, blank=True)
+    # MinHash-скетч множества треков для оценки общих треков
+    track_sketch = models.BinaryField(null=True, blank=True)
 
     def __str__(self):
         return f'{self.vk_id}: {self.name}'
+
+
+class UserGenreStats(models.Model):
+    """
+    Количество треков каждого жанра у пользователя. Поддерживается задачами
+    обновления треков и поиска жанров, чтобы не считать его при каждом
+    просмотре страницы пользователя.
+    """
+    user = models.ForeignKey(VkUser, on_delete=models.CASCADE)
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'genre'],
+                                    name='user_genre_stats_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.genre} ({self.count})'
@@ -0,0 +1,40 @@
+"""
+Хранение больших аргументов задач (списков треков и друзей) в redis.
+
+Данные сохраняются один раз, сжатыми, под ключом из хеша содержимого, а
+в сообщениях celery передаётся только ключ. Одинаковые списки хранятся
+в одном экземпляре, а повтор задачи не загружает их из vk заново.
+"""
+
+import hashlib
+import json
+import zlib
+
+import redis
+
+
+redis_client = redis.Redis()
+
+
+class PayloadExpired(Exception):
+    def __init__(self, key):
+        super().__init__(f'данные {key} не найдены, возможно истёк срок '
+                         f'хранения')
+        self.key = key
+
+
+def store(data, ttl):
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True).encode()
+    key = f'payload {hashlib.sha256(raw).hexdigest()}'
+
+    redis_client.set(key, zlib.compress(raw), ex=ttl)
+
+    return key
+
+
+def load(key):
+    value = redis_client.get(key)
+    if value is None:
+        raise PayloadExpired(key)
+
+    return json.loads(zlib.decompress(value))
@@ -0,0 +1,94 @@
+"""
+Ход обновления пользователя в redis.
+
+Задачи цепочки db_update_user атомарно увеличивают поля хеша
+'update progress {vk_id}' и номер его версии, после чего публикуют версию
+в канал с тем же именем. Страница пользователя ждёт изменений long-poll
+запросами (см. wait) и не перезагружает UserView, пока обновление идёт.
+"""
+
+import time
+
+import redis
+
+
+FIELDS = ('total_friends', 'lists_fetched', 'lists_skipped',
+          'tracks_ingested')
+
+# сколько хранится ход последнего обновления
+TTL = 24 * 60 * 60
+
+redis_client = redis.Redis()
+
+
+def key(vk_id):
+    return f'update progress {vk_id}'
+
+
+def _update(vk_id, state=None, reset=False, **increments):
+    progress_key = key(vk_id)
+
+    pipe = redis_client.pipeline()
+    if reset:
+        pipe.hdel(progress_key, *FIELDS)
+    if state:
+        pipe.hset(progress_key, 'state', state)
+    for field, amount in increments.items():
+        pipe.hincrby(progress_key, field, amount)
+    pipe.hincrby(progress_key, 'version', 1)
+    pipe.expire(progress_key, TTL)
+    version = pipe.execute()[-2]
+
+    redis_client.publish(progress_key, version)
+
+    return version
+
+
+def start(vk_id):
+    """Обнуляет счётчики перед новым обновлением пользователя."""
+    return _update(vk_id, 'in progress', reset=True)
+
+
+def incr(vk_id, **increments):
+    return _update(vk_id, **increments)
+
+
+def finish(vk_id):
+    return _update(vk_id, 'finished')
+
+
+def get(vk_id):
+    values = redis_client.hgetall(key(vk_id))
+
+    progress = {field: int(values.get(field.encode(), 0))
+                for field in (*FIELDS, 'version')}
+    progress['state'] = values.get(b'state', b'').decode()
+
+    return progress
+
+
+def wait(vk_id, version, timeout):
+    """
+    Ход обновления, как только его версия станет больше version, или
+    текущий ход по истечении timeout секунд.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(key(vk_id))
+
+    try:
+        # подписка оформлена до чтения, так что изменение между чтением и
+        # ожиданием не потеряется
+        progress = get(vk_id)
+        deadline = time.monotonic() + timeout
+
+        while progress['version'] <= version:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            if pubsub.get_message(timeout=remaining) is not None:
+                progress = get(vk_id)
+
+        return progress
+    finally:
+        pubsub.close()
@@ -0,0 +1,199 @@
+"""
+Рекомендации треков, которые есть у друзей пользователя, но нет у него.
+
+По таблице связей пользователей с треками в фоне строится разреженная
+матрица пользователи × треки (CSR), которая хранится в redis. Треки
+ранжируются по количеству друзей, у которых они есть, а при равенстве -
+по доле жанра трека среди треков пользователя. Готовые рекомендации
+кешируются для каждого пользователя до следующей перестройки матрицы.
+"""
+
+import io
+import itertools
+import json
+
+import numpy as np
+import redis
+from scipy import sparse
+
+from .models import Track, UserGenreStats, VkUser
+
+
+MATRIX_KEY = 'recommendations matrix'
+MATRIX_VERSION_KEY = 'recommendations matrix version'
+# поставлен, пока запрошенная перестройка матрицы не завершилась
+REBUILD_KEY = 'recommendations matrix rebuild'
+REBUILD_TIMEOUT = 30 * 60
+
+redis_client = redis.Redis()
+
+# последняя загруженная из redis матрица: (версия, матрица)
+_loaded = (None, None)
+
+
+class TrackMatrix:
+    """
+    matrix[i, j] = 1, если у пользователя user_ids[i] есть трек track_ids[j],
+    track_genres[j] - id жанра трека (-1, если жанр неизвестен).
+    """
+
+    def __init__(self, matrix, user_ids, track_ids, track_genres):
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.track_ids = track_ids
+        self.track_genres = track_genres
+        self._rows = {int(u): i for i, u in enumerate(user_ids)}
+
+    @classmethod
+    def build(cls):
+        through = VkUser.tracks.through
+        pairs = through.objects.order_by('vkuser_id').values_list(
+            'vkuser_id', 'track_id').iterator()
+        # пары читаются сразу в массив, без промежуточного списка кортежей
+        pairs = np.fromiter(itertools.chain.from_iterable(pairs),
+                            dtype=np.int64).reshape(-1, 2)
+
+        user_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+        track_ids, columns = np.unique(pairs[:, 1], return_inverse=True)
+
+        genres = dict(Track.objects.filter(genre__isnull=False)
+                      .values_list('id', 'genre_id').iterator())
+        track_genres = np.array([genres.get(int(t), -1) for t in track_ids],
+                                dtype=np.int64)
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(pairs), dtype=np.int32), (rows, columns)),
+            shape=(len(user_ids), len(track_ids)))
+
+        return cls(matrix, user_ids, track_ids, track_genres)
+
+    def dumps(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer, data=self.matrix.data, indices=self.matrix.indices,
+            indptr=self.matrix.indptr, shape=self.matrix.shape,
+            user_ids=self.user_ids, track_ids=self.track_ids,
+            track_genres=self.track_genres)
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, value):
+        arrays = np.load(io.BytesIO(value))
+        matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=tuple(arrays['shape']))
+        return cls(matrix, arrays['user_ids'], arrays['track_ids'],
+                   arrays['track_genres'])
+
+    def recommend(self, user_id, friend_ids, genre_share, k):
+        """
+        Лучшие k треков друзей, которых нет у пользователя:
+        список (id трека, количество друзей, доля жанра трека).
+        """
+        friend_rows = [self._rows[f] for f in friend_ids if f in self._rows]
+        if not friend_rows:
+            return []
+
+        friends_count = np.asarray(
+            self.matrix[friend_rows].sum(axis=0)).ravel().astype(np.float64)
+
+        if user_id in self._rows:
+            own = self.matrix[self._rows[user_id]].indices
+            friends_count[own] = 0
+
+        candidates = np.flatnonzero(friends_count)
+        if not candidates.size:
+            return []
+
+        # доля жанра по его id, сдвинутому на единицу: нулевой элемент
+        # соответствует неизвестному жанру (-1)
+        genres = self.track_genres[candidates]
+        share = np.zeros(int(max(genres.max(),
+                                 max(genre_share, default=-1))) + 2)
+        share[np.fromiter(genre_share.keys(), dtype=np.int64) + 1] = list(
+            genre_share.values())
+
+        # треки упорядочены по количеству друзей, а доля жанра влияет
+        # только на порядок треков с одинаковым количеством друзей
+        scores = share[genres + 1]
+        order = np.lexsort((-scores, -friends_count[candidates]))[:k]
+
+        return [(int(self.track_ids[j]), int(friends_count[j]), float(score))
+                for j, score in zip(candidates[order], scores[order])]
+
+
+def rebuild_matrix():
+    matrix = TrackMatrix.build()
+
+    pipe = redis_client.pipeline()
+    pipe.set(MATRIX_KEY, matrix.dumps())
+    pipe.incr(MATRIX_VERSION_KEY)
+    pipe.delete(REBUILD_KEY)
+    pipe.execute()
+
+    return matrix
+
+
+def claim_rebuild():
+    """
+    True, если перестройку матрицы нужно запустить: она ещё не запрошена
+    или запрос завис дольше REBUILD_TIMEOUT.
+    """
+    return bool(redis_client.set(REBUILD_KEY, 1, nx=True,
+                                 ex=REBUILD_TIMEOUT))
+
+
+def load_matrix():
+    global _loaded
+
+    version = redis_client.get(MATRIX_VERSION_KEY)
+    if version is None:
+        return None, None
+
+    if _loaded[0] != version:
+        value = redis_client.get(MATRIX_KEY)
+        if value is None:
+            return None, None
+        _loaded = (version, TrackMatrix.loads(value))
+
+    return _loaded
+
+
+def recommend(user, k=50, ttl=60 * 60):
+    """
+    Рекомендации пользователю: список словарей с исполнителем, названием,
+    жанром трека и количеством друзей, у которых он есть. None, если
+    матрица ещё не построена.
+    """
+    version, matrix = load_matrix()
+    if matrix is None:
+        return None
+
+    cache_key = f'recommendations {user.id} {int(version)} {k}'
+    cached = redis_client.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    genre_counts = dict(UserGenreStats.objects.filter(user=user, count__gt=0)
+                        .values_list('genre_id', 'count'))
+    total = sum(genre_counts.values()) or 1
+    genre_share = {g: count / total for g, count in genre_counts.items()}
+
+    friend_ids = list(user.friends.values_list('id', flat=True))
+    top = matrix.recommend(user.id, friend_ids, genre_share, k)
+
+    tracks = Track.objects.select_related('artist', 'genre').in_bulk(
+        [track_id for track_id, _, _ in top])
+    result = [
+        {'artist': tracks[track_id].artist.name,
+         'title': tracks[track_id].title,
+         'genre': tracks[track_id].genre.name
+         if tracks[track_id].genre else None,
+         'friends': friends,
+         'score': round(score, 3)}
+        for track_id, friends, score in top if track_id in tracks
+    ]
+
+    redis_client.set(cache_key, json.dumps(result, ensure_ascii=False),
+                     ex=ttl)
+    return result
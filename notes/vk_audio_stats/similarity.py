@@ -0,0 +1,161 @@
+"""
+Индекс похожих по вкусам пользователей среди всех пользователей в бд.
+
+Вектор жанров пользователя (из UserGenreStats) сжимается случайными
+проекциями в сигнатуру из SIGNATURE_BITS бит: у пользователей с похожими
+векторами совпадает большинство бит. Сигнатуры и LSH-корзины хранятся в
+redis: сигнатура делится на BANDS частей, пользователи с одинаковой частью
+попадают в одну корзину. Кандидаты в похожие берутся только из корзин
+пользователя, поэтому поиск не перебирает всех пользователей.
+
+Совпадение самих треков оценивается по MinHash-скетчам множеств треков
+пользователей, которые хранятся в VkUser.track_sketch.
+"""
+
+import functools
+import math
+
+import numpy as np
+import redis
+
+from .models import UserGenreStats
+
+
+# векторы жанров неотрицательны, поэтому биты их проекций часто совпадают
+# и у корзины должно быть достаточно бит, чтобы в неё попадали только
+# действительно похожие пользователи
+SIGNATURE_BITS = 128
+BANDS = 8
+BAND_BITS = SIGNATURE_BITS // BANDS
+
+# сколько кандидатов в похожие берётся из каждой корзины
+CANDIDATES_PER_BAND = 250
+
+# размер сигнатуры входит в ключи, сигнатуры другого размера после его
+# изменения строятся заново задачей similarity_rebuild_index
+SIGNATURES_KEY = f'similarity {SIGNATURE_BITS} signatures'
+
+SKETCH_SIZE = 128
+# хеш-функции MinHash: (a * x + b) mod p
+_SKETCH_PRIME = (1 << 31) - 1
+_SKETCH_A, _SKETCH_B = np.random.RandomState(0).randint(
+    1, _SKETCH_PRIME, size=(2, SKETCH_SIZE, 1), dtype=np.int64)
+
+redis_client = redis.Redis()
+
+
+@functools.lru_cache(maxsize=None)
+def genre_projection(genre_id):
+    # вектор проекций жанра не зависит от остальных жанров, поэтому
+    # сигнатуры не нужно пересчитывать при появлении новых жанров
+    return np.random.RandomState(genre_id).standard_normal(SIGNATURE_BITS)
+
+
+def signature(genre_counts):
+    """Сигнатура вектора {id жанра: количество треков}."""
+    projection = sum(count * genre_projection(genre_id)
+                     for genre_id, count in genre_counts.items())
+    bits = np.flatnonzero(projection > 0)
+
+    return sum(1 << int(b) for b in bits)
+
+
+def _band_keys(sig):
+    mask = (1 << BAND_BITS) - 1
+    return [f'similarity {SIGNATURE_BITS} band {b} '
+            f'{(sig >> (b * BAND_BITS)) & mask}'
+            for b in range(BANDS)]
+
+
+def similarity(sig_a, sig_b):
+    """Оценка косинусной близости по доле различающихся бит сигнатур."""
+    distance = bin(sig_a ^ sig_b).count('1')
+    return math.cos(math.pi * distance / SIGNATURE_BITS)
+
+
+def update_users(user_ids):
+    """Пересчитывает сигнатуры пользователей по текущей статистике жанров."""
+    user_ids = list(user_ids)
+
+    genre_counts = {user_id: {} for user_id in user_ids}
+    for user_id, genre_id, count in (
+            UserGenreStats.objects.filter(user_id__in=user_ids, count__gt=0)
+            .values_list('user_id', 'genre_id', 'count')):
+        genre_counts[user_id][genre_id] = count
+
+    old_signatures = redis_client.hmget(SIGNATURES_KEY, user_ids)
+
+    pipe = redis_client.pipeline()
+    for user_id, old in zip(user_ids, old_signatures):
+        if old is not None:
+            for key in _band_keys(int(old)):
+                pipe.srem(key, user_id)
+
+        if not genre_counts[user_id]:
+            pipe.hdel(SIGNATURES_KEY, user_id)
+            continue
+
+        sig = signature(genre_counts[user_id])
+        for key in _band_keys(sig):
+            pipe.sadd(key, user_id)
+        pipe.hset(SIGNATURES_KEY, user_id, sig)
+    pipe.execute()
+
+
+def most_similar(user_id, k=10):
+    """
+    Наиболее похожие на пользователя пользователи:
+    список (id пользователя, близость) по убыванию близости.
+    """
+    sig = redis_client.hget(SIGNATURES_KEY, user_id)
+    if sig is None:
+        return []
+
+    sig = int(sig)
+
+    # из каждой корзины берётся не больше CANDIDATES_PER_BAND случайных
+    # пользователей, так что поиск не зависит от размера корзин
+    pipe = redis_client.pipeline()
+    for key in _band_keys(sig):
+        pipe.srandmember(key, CANDIDATES_PER_BAND)
+    candidates = list({int(c) for members in pipe.execute()
+                       for c in members} - {user_id})
+    if not candidates:
+        return []
+
+    scores = [
+        (candidate, similarity(sig, int(other)))
+        for candidate, other in zip(
+            candidates, redis_client.hmget(SIGNATURES_KEY, candidates))
+        if other is not None
+    ]
+
+    return sorted(scores, key=lambda x: x[1], reverse=True)[:k]
+
+
+def track_sketch(track_ids):
+    """MinHash-скетч множества id треков, байты для VkUser.track_sketch."""
+    sketch = np.full(SKETCH_SIZE, _SKETCH_PRIME, dtype=np.int64)
+
+    track_ids = np.fromiter(track_ids, dtype=np.int64)
+    for i in range(0, len(track_ids), 4096):
+        chunk = track_ids[i:i + 4096]
+        hashes = (_SKETCH_A * chunk + _SKETCH_B) % _SKETCH_PRIME
+        sketch = np.minimum(sketch, hashes.min(axis=1))
+
+    return sketch.astype('<u4').tobytes()
+
+
+def track_overlap(sketch_a, count_a, sketch_b, count_b):
+    """
+    Оценка коэффициента Жаккара и количества общих треков двух
+    пользователей по их скетчам и количеству треков.
+    """
+    if not sketch_a or not sketch_b:
+        return 0.0, 0
+
+    jaccard = float(np.mean(np.frombuffer(bytes(sketch_a), dtype='<u4') ==
+                            np.frombuffer(bytes(sketch_b), dtype='<u4')))
+    shared = round(jaccard / (1 + jaccard) * (count_a + count_b))
+
+    return jaccard, shared
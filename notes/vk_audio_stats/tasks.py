@@ -1,17 +1,21 @@
+import functools
 import json
+import math
 import os
 import sys
 
-from functools import reduce
-from operator import or_
+from datetime import timedelta
 
 # import django
 # from celery import Celery
 import redis
+from celery import chord, group
 from celery.utils.log import get_task_logger
-from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
 
-from . import background_searcher
+from . import (background_searcher, catalog, payload, progress,
+               recommendations, similarity)
 from notes.celery import background_worker
 
 # sys.path.extend([os.getenv('DJANGO_PROJECT_PATH')])
@@ -43,16 +47,155 @@ def get_credentials():
         credentials = json.load(cred_file)
     return credentials
 
+def get_genre_cache():
+    return background_searcher.GenreCache(settings.GENRE_CACHE_TTL,
+                                          settings.GENRE_CACHE_NEGATIVE_TTL)
+
+def get_vk_api():
+    credentials = get_credentials()
+    return background_searcher.VkApiLockable(
+        credentials['vk'], rate_limits=settings.RATE_LIMITS,
+        batch_methods=settings.VK_BATCH_METHODS,
+        batch_delay=settings.VK_BATCH_DELAY)
+
+# версия статистики жанров, увеличивается при каждом её изменении и
+# входит в ключ кеша страницы жанров
+GENRE_STATS_VERSION_KEY = 'genre stats version'
+
+
+def genre_stats_changed():
+    redis_client.incr(GENRE_STATS_VERSION_KEY)
+
+
+# треки (json [исполнитель, трек]), ожидающие поиска жанра, и сколько
+# раз поиск каждого из них уже не удался
+GENRE_LOOKUP_PENDING_KEY = 'genre lookup pending'
+GENRE_LOOKUP_ATTEMPTS_KEY = 'genre lookup attempts'
+
+# очередь обновлений, запущенных пользователем: все задачи такого
+# обновления, кроме поиска жанров, выполняются отдельными воркерами
+INTERACTIVE_QUEUE = 'interactive'
+
+
 def redis_set_user_update_status(vk_id, state=True):
+    # незавершённое обновление не может висеть дольше REFRESH_TIMEOUT
     redis_client.set(f'update state {vk_id}',
-                     'in progress' if state else 'finished')
+                     'in progress' if state else 'finished',
+                     ex=settings.REFRESH_TIMEOUT if state else None)
+
+
+def chord_member(func):
+    """
+    Задача из группы chord обновления пользователя: ошибка записывается в
+    лог, а не прерывает chord, иначе finish не выполнился бы.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logger.exception(f'{func.__name__}{args}: ошибка')
+
+    return wrapper
+
+def refresh_key(vk_id):
+    return f'refresh {vk_id}'
+
+
+def start_user_refresh(vk_id, interactive=False):
+    """
+    Запускает обновление пользователя, если оно уже не идёт и не завершилось
+    в последние REFRESH_FRESHNESS секунд. Иначе новый запрос присоединяется
+    к существующему обновлению: его ход виден на странице пользователя.
+    Возвращает True, если обновление запущено.
+    """
+    vk_id = int(vk_id)
+
+    if not redis_client.set(refresh_key(vk_id), 'in progress', nx=True,
+                            ex=settings.REFRESH_TIMEOUT):
+        logger.info(f'обновление {vk_id} уже идёт или недавно завершено')
+        return False
+
+    if interactive:
+        db_update_user.apply_async((vk_id,), {'interactive': True},
+                                   queue=INTERACTIVE_QUEUE)
+    else:
+        db_update_user.delay(vk_id)
+
+    return True
+
+
+def track_list_key(vk_id):
+    # 'in progress' - список загружается одним из обновлений, 'done' -
+    # загружен в последние REFRESH_FRESHNESS секунд
+    return f'tracks refresh {vk_id}'
+
+
+def claim_track_lists(vk_ids):
+    """
+    Пользователи, списки треков которых нужно загрузить в этом обновлении,
+    и пользователи, списки которых сейчас загружает другое обновление:
+    его нужно дождаться. Проверенные в последние REFRESH_FRESHNESS секунд
+    списки не загружаются.
+    """
+    fresh_since = timezone.now() - timedelta(
+        seconds=settings.REFRESH_FRESHNESS)
+    fresh = set(VkUser.objects
+                .filter(vk_id__in=vk_ids, tracks_checked__gte=fresh_since)
+                .values_list('vk_id', flat=True))
+
+    candidates = [uid for uid in vk_ids if int(uid) not in fresh]
+
+    pipe = redis_client.pipeline()
+    for uid in candidates:
+        pipe.set(track_list_key(uid), 'in progress', nx=True,
+                 ex=settings.REFRESH_TIMEOUT)
+        pipe.get(track_list_key(uid))
+    results = pipe.execute()
+
+    claimed, waiting = [], []
+    for uid, is_claimed, state in zip(candidates, results[::2],
+                                      results[1::2]):
+        if is_claimed:
+            claimed.append(uid)
+        elif state == b'in progress':
+            waiting.append(uid)
+
+    return claimed, waiting
+
+
+def release_track_lists(vk_ids, loaded=True):
+    """
+    Снимает отметку загрузки списков: загруженные считаются свежими
+    REFRESH_FRESHNESS секунд, незагруженные может загрузить любое
+    обновление.
+    """
+    pipe = redis_client.pipeline()
+    for uid in vk_ids:
+        if loaded:
+            pipe.set(track_list_key(uid), 'done',
+                     ex=settings.REFRESH_FRESHNESS)
+        else:
+            pipe.delete(track_list_key(uid))
+    pipe.execute()
+
 
 @background_worker.task
-def db_update_user(vk_id):
+def db_update_user(vk_id, interactive=False):
+    vk_id = int(vk_id)
     redis_set_user_update_status(vk_id)
+    progress.start(vk_id)
 
-    credentials = get_credentials()
-    vk_api = background_searcher.VkApiLockable(credentials['vk'])
+    try:
+        start_update_tasks(vk_id, interactive)
+    except Exception:
+        finish.run(vk_id)
+        raise
+
+
+def start_update_tasks(vk_id, interactive):
+    """Создаёт пользователя и его друзей и запускает chord обновления."""
+    vk_api = get_vk_api()
 
     username = vk_api.username(vk_id)
 
@@ -67,41 +210,72 @@ def db_update_user(vk_id):
                 f'{"создан" if created else "уже существует"}')
 
     user_friends = vk_api.friends(vk_id)
+    progress.incr(vk_id, total_friends=len(user_friends))
+
+    # друзья создаются до запуска задач, чтобы сохранение их треков не
+    # зависело от обновления списка друзей
+    db_create_users(vk_id, user_friends)
 
     logger.info(f'задачи обновление друзей и треков {vk_id}')
 
-    tasks = [db_update_user_friends.si(vk_id, user_friends),
-             db_update_tracks.si(vk_id, vk_api.track_list(vk_id))]
-    tasks.extend([db_update_tracks.si(uid, vk_api.track_list(uid))
-                  for uid in user_friends])
-    tasks.append(finish.si(vk_id))
+    # в сообщения задач попадают только ключи сохранённых в redis данных
+    friends_key = payload.store(user_friends, settings.PAYLOAD_TTL)
 
-    task_chain = reduce(or_, tasks)
+    def lane(signature):
+        if interactive:
+            return signature.set(queue=INTERACTIVE_QUEUE)
+        return signature
 
-    task_chain()
+    # списки треков, которые уже загружаются другим обновлением или
+    # недавно проверены, не загружаются повторно, а загружаемые другими
+    # обновлениями дожидается finish
+    user_ids = [vk_id, *user_friends]
+    track_list_ids, waiting = claim_track_lists(user_ids)
+    progress.incr(vk_id, lists_skipped=len(user_ids) - len(track_list_ids))
 
+    # если audio.get вызывается через execute, списки треков загружаются
+    # пачками, по одному запросу к vk на пачку
+    chunk_size = (background_searcher.VkExecutePool.MAX_CALLS
+                  if 'audio.get' in settings.VK_BATCH_METHODS else 1)
 
-@background_worker.task
-def db_update_user_friends(vk_id, friends):
-    user_object = (VkUser.objects.prefetch_related('friends')
-                   .get(vk_id=vk_id))
+    # список друзей и списки треков обновляются параллельно, с ограничением
+    # частоты запросов к vk, каждая пачка списков сохраняется в бд сразу
+    # после загрузки, а finish выполняется после всех задач группы
+    tasks = group(
+        lane(db_update_user_friends.si(vk_id, friends_key)),
+        *(lane(vk_fetch_track_lists.si(uids, progress_id=vk_id))
+          | lane(db_update_track_lists.s(progress_id=vk_id))
+          for uids in catalog.chunks(track_list_ids, chunk_size)))
 
-    friends = {int(uid): name for uid, name in friends.items()}
+    chord(tasks)(lane(finish.si(vk_id, waiting)))
 
-    users_in_db = (VkUser.objects
-                   .filter(vk_id__in=[user_id for user_id in friends])
-                   .values_list('vk_id', flat=True))
 
-    users_to_add = {uid: name for uid, name in friends.items()
+def db_create_users(vk_id, users):
+    users = {int(uid): name for uid, name in users.items()}
+
+    users_in_db = set(VkUser.objects.filter(vk_id__in=list(users))
+                      .values_list('vk_id', flat=True))
+
+    users_to_add = {uid: name for uid, name in users.items()
                     if uid not in users_in_db}
 
-    objs = (VkUser(vk_id=vk_id, name=name)
-            for vk_id, name in users_to_add.items())
-    VkUser.objects.bulk_create(objs)
+    objs = (VkUser(vk_id=uid, name=name)
+            for uid, name in users_to_add.items())
+    VkUser.objects.bulk_create(objs, ignore_conflicts=True)
 
     logger.info(f'{vk_id} добавлено пользователей '
                 f'{len(users_to_add)}: {users_to_add}')
 
+
+@background_worker.task
+@chord_member
+def db_update_user_friends(vk_id, friends_key):
+    user_object = (VkUser.objects.prefetch_related('friends')
+                   .get(vk_id=vk_id))
+
+    friends = {int(uid): name
+               for uid, name in payload.load(friends_key).items()}
+
     user_friends_in_db = [u.vk_id for u in user_object.friends.all()]
     friends_to_add = (VkUser.objects.filter(vk_id__in=friends)
                       .exclude(vk_id__in=user_friends_in_db))
@@ -118,90 +292,361 @@ def db_update_user_friends(vk_id, friends):
 
 
 @background_worker.task
-def db_update_tracks(vk_id, track_list):
+@chord_member
+def vk_fetch_track_lists(vk_ids, progress_id=None):
+    """Загружает списки треков пользователей, возвращает {vk_id: ключ}."""
+    try:
+        track_lists = get_vk_api().track_lists(vk_ids)
+    except Exception:
+        release_track_lists(vk_ids, loaded=False)
+        raise
+
+    if progress_id:
+        progress.incr(progress_id, lists_fetched=len(track_lists))
+
+    keys = {}
+    for vk_id, track_list in track_lists.items():
+        logger.info(f'{vk_id}: загружено {len(track_list)} треков из vk')
+        keys[vk_id] = payload.store(track_list, settings.PAYLOAD_TTL)
+
+    return keys
+
+
+@background_worker.task
+@chord_member
+def db_update_track_lists(track_list_keys, progress_id=None):
+    # None - загрузка списков завершилась ошибкой
+    for vk_id, key in (track_list_keys or {}).items():
+        try:
+            db_update_tracks(key, int(vk_id), progress_id=progress_id)
+        except Exception:
+            logger.exception(f'{vk_id}: ошибка сохранения списка треков')
+            release_track_lists([vk_id], loaded=False)
+        else:
+            release_track_lists([vk_id])
+
+
+@background_worker.task
+def db_update_tracks(track_list_key, vk_id, progress_id=None):
+    track_list = payload.load(track_list_key)
     if not track_list:
         return
 
-    user_object = VkUser.objects.prefetch_related('tracks').get(vk_id=vk_id)
+    if progress_id:
+        progress.incr(progress_id, tracks_ingested=len(track_list))
 
-    new_artists = set(a for a, t in track_list
-                      if not Artist.objects.filter(name=a).exists() and
-                      len(a) <= Artist._meta.get_field('name').max_length)
+    user_object = VkUser.objects.get(vk_id=vk_id)
 
-    objs = (Artist(name=a) for a in new_artists)
-    Artist.objects.bulk_create(objs)
+    tracks_hash, tracks_count = catalog.fingerprint(track_list)
+    if user_object.tracks_hash == tracks_hash:
+        (VkUser.objects.filter(id=user_object.id)
+         .update(tracks_checked=timezone.now()))
+        logger.info(f'{vk_id}: список треков не изменился')
+        return
 
-    logger.info(f'{vk_id}: добавлено {len(new_artists)} исполнителей в бд.')
+    track_ids, new_tracks = catalog.upsert_catalog(track_list)
 
-    new_tracks = list(
-        set((a, t) for a, t in track_list
-            if a in new_artists and
-            not Track.objects.filter(title=t, artist__name=a).exists() and
-            len(t) <= Track._meta.get_field('title').max_length))
+    logger.info(f'{vk_id}: добавлено {len(new_tracks)} треков в бд.')
 
-    objs = (Track(title=t, artist=Artist.objects.get(name=a))
-            for a, t in new_tracks)
-    Track.objects.bulk_create(objs)
+    queue_genre_lookups(new_tracks)
 
-    logger.info(f'{vk_id}: добавлено {len(new_tracks)} треков в бд.')
+    added, removed = catalog.sync_user_tracks(user_object.id,
+                                              track_ids.values())
+
+    logger.info(f'пользователю {vk_id} добавлено {added}')
+    logger.info(f'у пользователя {vk_id} удалено {removed}')
 
-    db_update_track_genre.delay(new_tracks)
+    (VkUser.objects.filter(id=user_object.id)
+     .update(tracks_hash=tracks_hash, tracks_count=tracks_count,
+             tracks_checked=timezone.now(),
+             track_sketch=similarity.track_sketch(track_ids.values())))
 
-    condition = reduce(or_, [Q(title=t, artist__name=a) for a, t in track_list])
-    tracks_to_add = (Track.objects.filter(condition)
-                     .difference(user_object.tracks.all()))
+    if added or removed:
+        genre_stats_changed()
+        similarity_update_users.delay([user_object.id])
 
-    user_object.tracks.add(*tracks_to_add)
 
-    logger.info(f'пользователю {vk_id} добавлено {tracks_to_add.count()}')
+def db_get_genre(name):
+    genre_object, created = Genre.objects.get_or_create(
+        name=name, defaults={'name': name})
+    if created:
+        genre_object.save()
 
-    tracks_to_remove = (user_object.tracks.all()
-                        .difference(Track.objects.filter(condition)))
-    user_object.tracks.remove(*tracks_to_remove)
+    return genre_object
 
-    logger.info(f'у пользователя {vk_id} удалено {tracks_to_remove.count()}')
 
+def db_set_track_genre(artist, track, genre):
+    _, users = catalog.set_tracks_genre(
+        Track.objects.filter(title=track, artist__name=artist),
+        db_get_genre(genre))
 
-@background_worker.task
-def db_update_track_genre(track_list):
-    credentials = get_credentials()
+    return users
 
-    tag_finder = background_searcher.TagFinderLockable(credentials['discogs'])
+
+def update_genre_by_track(tag_finder, track_list):
+    """
+    Возвращает пользователей, у которых изменились жанры треков, и треки,
+    поиск которых не удался: провайдеры не ответили вовремя или произошла
+    ошибка. Ошибка на одном треке не мешает остальным.
+    """
+    users = set()
+    failed = []
 
     for artist, track in track_list:
         logger.info(f'поиск жанра {artist} - {track}')
-        genre = tag_finder.find(artist, track)
+        try:
+            genre = tag_finder.find(artist, track)
+            if not genre:
+                continue
+
+            logger.info(f'трек {artist} - {track} ({genre})')
+
+            users |= db_set_track_genre(artist, track, genre)
+        except background_searcher.ProviderTimeout as ex:
+            logger.warning(ex)
+            failed.append((artist, track))
+        except Exception:
+            logger.exception(f'ошибка поиска жанра {artist} - {track}')
+            failed.append((artist, track))
+
+    return users, failed
+
+
+def update_genre_by_artist(tag_finder, genre_cache, track_list):
+    """
+    Жанр ищется один раз на исполнителя и сохраняется в Artist.genre, после
+    чего проставляется всем его трекам без жанра. Если для трека в кеше уже
+    есть собственный жанр, используется он.
+
+    Возвращает то же, что update_genre_by_track.
+    """
+    artist_tracks = {}
+    for artist, track in track_list:
+        artist_tracks.setdefault(artist, []).append(track)
+
+    artists = Artist.objects.select_related('genre').filter(
+        name__in=artist_tracks)
+    users = set()
+    failed = []
+
+    for artist_object in artists:
+        artist = artist_object.name
+
+        try:
+            users |= update_artist_genre(tag_finder, genre_cache,
+                                         artist_object, artist_tracks[artist])
+        except background_searcher.ProviderTimeout as ex:
+            logger.warning(ex)
+            failed.extend((artist, t) for t in artist_tracks[artist])
+        except Exception:
+            logger.exception(f'ошибка поиска жанра исполнителя {artist}')
+            failed.extend((artist, t) for t in artist_tracks[artist])
+
+    return users, failed
+
+
+def update_artist_genre(tag_finder, genre_cache, artist_object, tracks):
+    """
+    Жанр исполнителя для update_genre_by_artist, возвращает пользователей,
+    у которых изменились жанры треков.
+    """
+    artist = artist_object.name
+    users = set()
+
+    for track in tracks:
+        cached = genre_cache.peek(artist, track)
+        if cached and cached['genre']:
+            logger.info(f'трек {artist} - {track} ({cached["genre"]})')
+            users |= db_set_track_genre(artist, track, cached['genre'])
+
+    if artist_object.genre is None:
+        logger.info(f'поиск жанра исполнителя {artist}')
+        genre = tag_finder.find_artist(artist)
         if not genre:
-            continue
-
-        logger.info(f'трек {artist} - {track} ({genre})')
-
-        genre_object, created = Genre.objects.get_or_create(
-            name=genre, defaults={'name': genre})
-        if created:
-            genre_object.save()
-
-        # TODO: разобраться, откуда берутся одинаковые треки
-        if (Track.objects.prefetch_related('vkuser_set')
-                .filter(title=track, artist__name=artist).count() > 1):
-            track_objects = sorted(
-                Track.objects.prefetch_related('vkuser_set')
-                    .filter(title=track, artist__name=artist),
-                key=lambda x: x.vkuser_set.count(), reverse=True)
-            actual = track_objects[0]
-            to_delete = track_objects[1:]
-
-            for t_obj in to_delete:
-                users = t_obj.vkuser_set.all()
-                actual.vkuser_set.add(*users)
-                t_obj.vkuser_set.remove(*users)
-                t_obj.delete()
-
-        track_object = Track.objects.get(title=track, artist__name=artist)
-        track_object.genre = genre_object
-        track_object.save()
+            return users
+
+        artist_object.genre = db_get_genre(genre)
+        artist_object.save()
+
+    updated, artist_users = catalog.set_tracks_genre(
+        Track.objects.filter(artist=artist_object, genre__isnull=True),
+        artist_object.genre)
+    users |= artist_users
+
+    logger.info(f'исполнитель {artist} ({artist_object.genre}), '
+                f'жанр проставлен {updated} трекам')
+
+    return users
+
+
+def queue_genre_lookups(track_list, countdown=None):
+    """
+    Добавляет треки в общую для всех обновлений очередь поиска жанров.
+    Очередь - множество в redis, поэтому трек, добавленный несколькими
+    пользователями, ищется один раз. На каждые GENRE_LOOKUP_CHUNK_SIZE
+    действительно новых треков запускается задача, разбирающая очередь,
+    через countdown секунд, если он задан.
+    """
+    if not track_list:
+        return 0
+
+    added = redis_client.sadd(
+        GENRE_LOOKUP_PENDING_KEY,
+        *(json.dumps(pair, ensure_ascii=False) for pair in track_list))
+
+    tasks = math.ceil(added / settings.GENRE_LOOKUP_CHUNK_SIZE)
+    if tasks:
+        group(db_drain_genre_lookups.si() for _ in range(tasks)).apply_async(
+            countdown=countdown)
+
+    logger.info(f'в очередь поиска жанров добавлено {added} треков, '
+                f'запущено задач {tasks}')
+
+    return added
+
+
+def retry_genre_lookups(track_list):
+    """
+    Возвращает в очередь треки, поиск жанра которых не удался, с задержкой
+    GENRE_LOOKUP_RETRY_DELAY. Трек, поиск которого не удался
+    GENRE_LOOKUP_MAX_ATTEMPTS раз, больше не ищется: в кеш жанров
+    записывается отрицательный результат.
+    """
+    if not track_list:
+        return
+
+    items = [json.dumps(pair, ensure_ascii=False) for pair in track_list]
+    pipe = redis_client.pipeline()
+    for item in items:
+        pipe.hincrby(GENRE_LOOKUP_ATTEMPTS_KEY, item, 1)
+    attempts = pipe.execute()
+
+    retry = []
+    dropped = []
+    for pair, item, attempt in zip(track_list, items, attempts):
+        if attempt < settings.GENRE_LOOKUP_MAX_ATTEMPTS:
+            retry.append(pair)
+        else:
+            dropped.append(item)
+
+            artist, track = pair
+            if settings.GENRE_RESOLUTION == 'artist':
+                track = None
+            get_genre_cache().set(artist, track, None)
+
+    if dropped:
+        redis_client.hdel(GENRE_LOOKUP_ATTEMPTS_KEY, *dropped)
+        logger.warning(f'поиск жанра {len(dropped)} треков не удался '
+                       f'{settings.GENRE_LOOKUP_MAX_ATTEMPTS} раз, '
+                       f'треки убраны из очереди')
+
+    queue_genre_lookups(retry, countdown=settings.GENRE_LOOKUP_RETRY_DELAY)
+
 
 @background_worker.task
-def finish(vk_id):
+def db_drain_genre_lookups():
+    items = redis_client.spop(GENRE_LOOKUP_PENDING_KEY,
+                              settings.GENRE_LOOKUP_CHUNK_SIZE)
+    if not items:
+        return
+
+    track_list = [tuple(json.loads(i)) for i in items]
+    try:
+        failed = update_track_genre(track_list)
+    except Exception:
+        # ошибка вне поиска отдельных треков: весь кусок ищется ещё раз
+        # позже, но не больше GENRE_LOOKUP_MAX_ATTEMPTS раз
+        retry_genre_lookups(track_list)
+        raise
+
+    failed_pairs = set(failed)
+    found = [item for item, pair in zip(items, track_list)
+             if pair not in failed_pairs]
+    if found:
+        redis_client.hdel(GENRE_LOOKUP_ATTEMPTS_KEY, *found)
+
+    retry_genre_lookups(failed)
+
+
+def update_track_genre(track_list):
+    """
+    Ищет жанры треков, возвращает треки, поиск которых не удался из-за
+    таймаута или ошибки.
+    """
+    credentials = get_credentials()
+
+    genre_cache = get_genre_cache()
+    tag_finder = background_searcher.TagFinderLockable(
+        credentials['discogs'], cache=genre_cache,
+        concurrent=settings.GENRE_LOOKUP_CONCURRENT,
+        timeouts=settings.GENRE_PROVIDER_TIMEOUTS,
+        callers=settings.GENRE_LOOKUP_THREADS,
+        rate_limits=settings.RATE_LIMITS)
+
+    if settings.GENRE_RESOLUTION == 'artist':
+        users, failed = update_genre_by_artist(tag_finder, genre_cache,
+                                               track_list)
+    else:
+        users, failed = update_genre_by_track(tag_finder, track_list)
+
+    logger.info(f'кеш жанров: {genre_cache.stats()}')
+
+    if users:
+        genre_stats_changed()
+        similarity_update_users.delay(sorted(users))
+
+    return failed
+
+
+@background_worker.task
+def db_rebuild_user_genre_stats():
+    catalog.rebuild_user_genre_stats()
+    genre_stats_changed()
+    logger.info('статистика жанров пользователей пересчитана')
+
+
+@background_worker.task
+def similarity_update_users(user_ids):
+    similarity.update_users(user_ids)
+    logger.info(f'индекс похожих пользователей обновлён: {len(user_ids)}')
+
+
+@background_worker.task
+def similarity_rebuild_index():
+    user_ids = list(VkUser.objects.values_list('id', flat=True))
+    for chunk in catalog.chunks(user_ids, 1000):
+        similarity.update_users(chunk)
+
+    logger.info(f'индекс похожих пользователей построен: {len(user_ids)}')
+
+
+@background_worker.task
+def recommendations_rebuild_matrix():
+    matrix = recommendations.rebuild_matrix()
+    logger.info(f'матрица рекомендаций построена: {matrix.matrix.shape}, '
+                f'{matrix.matrix.nnz} связей')
+
+
+@background_worker.task(bind=True, max_retries=None)
+def finish(self, vk_id, waiting=()):
+    """
+    Завершает обновление, когда сохранены и списки треков из waiting,
+    которые загружали другие обновления. Зависшие загрузки не задерживают
+    его дольше REFRESH_TIMEOUT: их отметки истекают.
+    """
+    if waiting:
+        states = redis_client.mget([track_list_key(uid) for uid in waiting])
+        waiting = [uid for uid, state in zip(waiting, states)
+                   if state == b'in progress']
+        if waiting:
+            logger.info(f'{vk_id}: ожидание списков треков {waiting}')
+            raise self.retry(args=(vk_id, waiting),
+                             countdown=settings.REFRESH_WAIT_INTERVAL)
+
     redis_set_user_update_status(vk_id, False)
+    progress.finish(vk_id)
+
+    # повторные запросы в течение REFRESH_FRESHNESS не запускают обновление
+    redis_client.set(refresh_key(vk_id), 'finished',
+                     ex=settings.REFRESH_FRESHNESS)
     logger.info(f'обновление {vk_id} завершено')
@@ -1,8 +1,26 @@
-from django.db import transaction
+import json
+import re
+import time
+from concurrent import futures
+
+import numpy as np
+from scipy import sparse
+
+from django.db import IntegrityError, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
 from django.db.models import Count, Q
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils.http import urlencode
 
-from .models import Artist, Genre, Track, VkUser
+from .background_searcher import (ProviderTimeout, TagFinder, VkApi,
+                                 VkExecuteError, VkExecutePool)
+from .catalog import (rebuild_user_genre_stats, set_tracks_genre,
+                      sync_user_tracks, upsert_catalog)
+from .compatibility import GenreMatrix
+from .models import Artist, Genre, Track, UserGenreStats, VkUser
+from .recommendations import TrackMatrix
+from .similarity import track_overlap, track_sketch
+from .views import genre_users, genre_users_page, iter_genre_users
 
 
 def prepare_data():
@@ -196,3 +214,498 @@ class VkUserModelTest(TestCase):
 
         self.assertDictEqual(common['Gordon Freeman'],
                              {'hard rock': 1, 'post rock': 1})
+
+
+class GenreMatrixTest(SimpleTestCase):
+    def setUp(self):
+        """
+        Жанры пользователей из prepare_data: Heisenberg и его друзья
+        Cat Whiskers и Gordon Freeman.
+        """
+        users = [VkUser(vk_id=1, name='Heisenberg'),
+                 VkUser(vk_id=2, name='Cat Whiskers'),
+                 VkUser(vk_id=3, name='Gordon Freeman')]
+        genres = ['blues', 'hard bop', 'hard rock', 'post metal',
+                  'post rock', 'punk rock', 'rap']
+        counts = [[0, 1, 1, 1, 2, 0, 0],
+                  [1, 0, 1, 1, 1, 1, 0],
+                  [2, 0, 1, 0, 1, 0, 1]]
+
+        self.matrix = GenreMatrix(users, genres, counts, [5, 5, 5])
+
+    def test_common(self):
+        common = self.matrix.common()
+
+        self.assertDictEqual(common['Cat Whiskers'],
+                             {'hard rock': 1, 'post rock': 1, 'post metal': 1})
+        self.assertDictEqual(common['Gordon Freeman'],
+                             {'hard rock': 1, 'post rock': 1})
+
+    def test_common_for_all(self):
+        self.assertDictEqual(
+            self.matrix.common_for_all(),
+            {
+                'hard rock': [('Cat Whiskers', 1), ('Gordon Freeman', 1),
+                              ('Heisenberg', 1)],
+                'post rock': [('Cat Whiskers', 1), ('Gordon Freeman', 1),
+                              ('Heisenberg', 2)]
+            }
+        )
+
+    def test_friends_with_common(self):
+        users = [VkUser(vk_id=1, name='Heisenberg'),
+                 VkUser(vk_id=2, name='Cat Whiskers'),
+                 VkUser(vk_id=3, name='Gordon Freeman')]
+        matrix = GenreMatrix(users, ['blues', 'rap'],
+                             [[1, 0], [0, 2], [3, 0]], [1, 2, 3])
+
+        self.assertListEqual(
+            [u.vk_id for u in matrix.friends_with_common()], [3])
+
+    def test_compatibility(self):
+        self.assertDictEqual(self.matrix.compatibility(),
+                             {'Cat Whiskers': 60.0, 'Gordon Freeman': 40.0})
+
+    def test_same_names_are_distinguished(self):
+        users = [VkUser(vk_id=1, name='Heisenberg'),
+                 VkUser(vk_id=2, name='Walter White'),
+                 VkUser(vk_id=3, name='Walter White')]
+        matrix = GenreMatrix(users, ['blues'], [[1], [1], [1]], [1, 1, 2])
+
+        self.assertDictEqual(matrix.compatibility(),
+                             {'Walter White (2)': 100.0,
+                              'Walter White (3)': 50.0})
+
+
+class TrackSketchTest(SimpleTestCase):
+    def test_track_overlap(self):
+        a = range(0, 1000)
+        b = range(500, 1500)
+
+        jaccard, shared = track_overlap(track_sketch(a), len(a),
+                                        track_sketch(b), len(b))
+
+        # точные значения: коэффициент Жаккара 1/3, общих треков 500
+        self.assertAlmostEqual(jaccard, 1 / 3, delta=0.1)
+        self.assertAlmostEqual(shared, 500, delta=100)
+
+    def test_same_tracks(self):
+        sketch = track_sketch([5, 3, 1])
+
+        self.assertEqual(track_overlap(sketch, 3, track_sketch([1, 3, 5]), 3),
+                         (1.0, 3))
+
+    def test_no_sketch(self):
+        self.assertEqual(track_overlap(None, 0, track_sketch([1]), 1),
+                         (0.0, 0))
+
+
+class TrackMatrixTest(SimpleTestCase):
+    def test_recommend(self):
+        matrix = TrackMatrix(
+            sparse.csr_matrix([[1, 0, 0, 0], [1, 1, 1, 0], [0, 1, 1, 1]]),
+            np.array([10, 11, 12]), np.array([100, 101, 102, 103]),
+            np.array([5, -1, 7, 5]))
+
+        # трек 100 уже есть у пользователя, при равном количестве друзей
+        # выше трек более частого у пользователя жанра
+        self.assertListEqual(
+            [(t, f) for t, f, _ in
+             matrix.recommend(10, [11, 12], {7: 0.3, 5: 0.2}, 10)],
+            [(102, 2), (101, 2), (103, 1)])
+        self.assertListEqual(matrix.recommend(10, [13], {}, 10), [])
+
+    def test_recommend_whole_share(self):
+        matrix = TrackMatrix(
+            sparse.csr_matrix([[1, 0, 0], [0, 1, 1], [0, 0, 1]]),
+            np.array([10, 11, 12]), np.array([100, 101, 102]),
+            np.array([5, 5, 7]))
+
+        # доля жанра, равная единице, не уравнивает трек одного друга с
+        # треком двух друзей
+        self.assertListEqual(matrix.recommend(10, [11, 12], {5: 1.0}, 2),
+                             [(102, 2, 0.0), (101, 1, 1.0)])
+
+
+class CatalogTest(TestCase):
+    multi_db = True
+
+    def test_upsert_catalog(self):
+        Artist(name='artist_1').save()
+
+        track_list = [('artist_1', 'track_1'), ('artist_2', 'track_2'),
+                      ('artist_2', 'track_2'), ('a' * 200, 'track_3')]
+
+        with self.assertNumQueries(5, using='audios_db'):
+            track_ids, new_tracks = upsert_catalog(track_list)
+
+        self.assertSetEqual(set(new_tracks),
+                            {('artist_1', 'track_1'), ('artist_2', 'track_2')})
+        self.assertEqual(
+            track_ids[('artist_1', 'track_1')],
+            Track.objects.get(artist__name='artist_1', title='track_1').id)
+
+        track_ids_again, new_tracks = upsert_catalog(track_list)
+
+        self.assertListEqual(new_tracks, [])
+        self.assertDictEqual(track_ids_again, track_ids)
+        self.assertEqual(Track.objects.count(), 2)
+
+    def test_track_is_unique(self):
+        artist = Artist(name='artist_1')
+        artist.save()
+        Track(title='track_1', artist=artist).save()
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic(using='audios_db'):
+                Track(title='track_1', artist=artist).save()
+
+    def test_sync_user_tracks(self):
+        user = VkUser(vk_id=1, name='Heisenberg')
+        user.save()
+
+        track_ids, _ = upsert_catalog([('artist_1', 'track_1'),
+                                       ('artist_1', 'track_2'),
+                                       ('artist_2', 'track_3')])
+        user.tracks.add(track_ids[('artist_1', 'track_1')],
+                        track_ids[('artist_1', 'track_2')])
+
+        added, removed = sync_user_tracks(
+            user.id, [track_ids[('artist_1', 'track_2')],
+                      track_ids[('artist_2', 'track_3')]])
+
+        self.assertEqual((added, removed), (1, 1))
+        self.assertSetEqual(
+            set(user.tracks.values_list('title', flat=True)),
+            {'track_2', 'track_3'})
+
+
+class UserGenreStatsTest(TestCase):
+    """
+    Статистика жанров, обновляемая по изменениям, должна совпадать с
+    пересчитанной с нуля.
+    """
+    multi_db = True
+
+    def setUp(self):
+        self.blues = Genre(name='blues')
+        self.blues.save()
+        self.rap = Genre(name='rap')
+        self.rap.save()
+
+        self.users = [VkUser(vk_id=1, name='Heisenberg'),
+                      VkUser(vk_id=2, name='Cat Whiskers')]
+        for user in self.users:
+            user.save()
+
+        self.track_ids, _ = upsert_catalog([('artist_1', 'track_1'),
+                                            ('artist_1', 'track_2'),
+                                            ('artist_2', 'track_3')])
+
+    def tracks(self, *titles):
+        return [i for (_, title), i in self.track_ids.items()
+                if title in titles]
+
+    def stats(self):
+        return set(UserGenreStats.objects
+                   .values_list('user_id', 'genre_id', 'count'))
+
+    def assertStatsMatchRebuild(self):
+        incremental = self.stats()
+        rebuild_user_genre_stats()
+        self.assertSetEqual(incremental, self.stats())
+
+    def test_sync_user_tracks(self):
+        set_tracks_genre(Track.objects.filter(title='track_1'), self.blues)
+        set_tracks_genre(Track.objects.filter(title='track_3'), self.rap)
+
+        sync_user_tracks(self.users[0].id, self.tracks('track_1', 'track_2'))
+        sync_user_tracks(self.users[1].id, self.tracks('track_1', 'track_3'))
+        self.assertStatsMatchRebuild()
+        self.assertIn((self.users[0].id, self.blues.id, 1), self.stats())
+
+        sync_user_tracks(self.users[0].id, self.tracks('track_3'))
+        self.assertStatsMatchRebuild()
+        self.assertNotIn(self.blues.id,
+                         UserGenreStats.objects.filter(user=self.users[0])
+                         .values_list('genre_id', flat=True))
+
+    def test_set_tracks_genre(self):
+        sync_user_tracks(self.users[0].id,
+                         self.tracks('track_1', 'track_2', 'track_3'))
+        sync_user_tracks(self.users[1].id, self.tracks('track_1'))
+
+        count, users = set_tracks_genre(
+            Track.objects.filter(artist__name='artist_1'), self.blues)
+        self.assertEqual(count, 2)
+        self.assertSetEqual(users, {u.id for u in self.users})
+        self.assertStatsMatchRebuild()
+
+        # трек переходит из одного жанра в другой
+        set_tracks_genre(Track.objects.filter(title='track_1'), self.rap)
+        self.assertStatsMatchRebuild()
+        self.assertSetEqual(
+            set(UserGenreStats.objects.filter(user=self.users[1])
+                .values_list('genre_id', 'count')),
+            {(self.rap.id, 1)})
+
+
+class GenreUsersTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        blues = Genre(name='blues')
+        blues.save()
+        rap = Genre(name='rap')
+        rap.save()
+        pop = Genre(name='pop')
+        pop.save()
+        self.genre_ids = [blues.id, rap.id]
+
+        self.users = []
+        for vk_id in range(1, 8):
+            user = VkUser(vk_id=vk_id, name=f'user_{vk_id}')
+            user.save()
+            self.users.append(user)
+
+            UserGenreStats(user=user, genre=blues, count=vk_id).save()
+            if vk_id % 2:
+                UserGenreStats(user=user, genre=rap, count=1).save()
+
+        # пользователь только с другими жанрами и обнулившаяся статистика
+        # в выборку не попадают
+        other = VkUser(vk_id=100, name='other')
+        other.save()
+        UserGenreStats(user=other, genre=pop, count=3).save()
+        UserGenreStats(user=other, genre=blues, count=0).save()
+
+    def test_page_boundaries(self):
+        first = genre_users(self.genre_ids, limit=3)
+        self.assertListEqual([u[1] for u in first], [1, 2, 3])
+        self.assertTupleEqual(
+            first[0], (self.users[0].id, 1, 'user_1', {'Blues': 1, 'Rap': 1}))
+        self.assertDictEqual(first[1][3], {'Blues': 2})
+
+        second = genre_users(self.genre_ids, after=first[-1][0], limit=3)
+        self.assertListEqual([u[1] for u in second], [4, 5, 6])
+
+        last = genre_users(self.genre_ids, after=second[-1][0], limit=3)
+        self.assertListEqual([u[1] for u in last], [7])
+        self.assertListEqual(
+            genre_users(self.genre_ids, after=last[-1][0], limit=3), [])
+
+    def test_export_has_no_duplicates_or_gaps(self):
+        everyone = genre_users(self.genre_ids)
+
+        for page_size in (1, 2, 3, 7, 10):
+            self.assertListEqual(
+                list(iter_genre_users(self.genre_ids, page_size)), everyone)
+        self.assertListEqual([u[1] for u in everyone], list(range(1, 8)))
+
+    def test_next_page(self):
+        user_list, next_page = genre_users_page(self.genre_ids, 0, 3)
+        self.assertEqual(len(user_list), 3)
+        self.assertEqual(next_page,
+                         urlencode([('genre', g) for g in self.genre_ids]
+                                   + [('after', user_list[-1][0])]))
+
+        user_list, next_page = genre_users_page(self.genre_ids,
+                                                self.users[3].id, 3)
+        # ровно три оставшихся пользователя: страница последняя
+        self.assertListEqual([u[1] for u in user_list], [5, 6, 7])
+        self.assertIsNone(next_page)
+
+
+class MergeDuplicateTracksMigrationTest(TransactionTestCase):
+    multi_db = True
+
+    migrate_from = [('vk_audio_stats', '0003_artist_genre')]
+    migrate_to = [('vk_audio_stats', '0004_track_unique_artist_title')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connections['audios_db'])
+        executor.loader.build_graph()
+        executor.migrate(targets)
+
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connections['audios_db'])
+        self.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_duplicate_tracks_are_merged(self):
+        apps = self.migrate(self.migrate_from)
+        Artist_ = apps.get_model('vk_audio_stats', 'Artist')
+        Genre_ = apps.get_model('vk_audio_stats', 'Genre')
+        Track_ = apps.get_model('vk_audio_stats', 'Track')
+        VkUser_ = apps.get_model('vk_audio_stats', 'VkUser')
+
+        artist = Artist_.objects.create(name='artist_1')
+        genre = Genre_.objects.create(name='blues')
+        first = Track_.objects.create(artist=artist, title='track_1')
+        duplicate = Track_.objects.create(artist=artist, title='track_1',
+                                          genre=genre)
+        user = VkUser_.objects.create(vk_id=1, name='Heisenberg')
+        user.tracks.add(duplicate)
+
+        apps = self.migrate(self.migrate_to)
+        Track_ = apps.get_model('vk_audio_stats', 'Track')
+        VkUser_ = apps.get_model('vk_audio_stats', 'VkUser')
+
+        track = Track_.objects.get()
+        self.assertEqual(track.id, first.id)
+        self.assertEqual(track.genre_id, genre.id)
+        self.assertListEqual(
+            list(VkUser_.objects.get(vk_id=1).tracks
+                 .values_list('id', flat=True)),
+            [first.id])
+
+
+class VkExecutePoolTest(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+
+    def execute(self, code):
+        """
+        Заглушка execute api vk: выполняет users.get из кода запроса,
+        пользователи с отрицательным id не существуют.
+        """
+        self.requests.append(code)
+
+        response, errors = [], []
+        for method, params in re.findall(r'API\.([\w.]+)\((\{.*?\})\)', code):
+            user_id = json.loads(params)['user_ids']
+            if user_id < 0:
+                response.append(False)
+                errors.append({'method': method, 'error_code': 113})
+            else:
+                response.append([{'id': user_id}])
+
+        return {'response': response, 'execute_errors': errors}
+
+    def test_calls_are_sent_by_25(self):
+        pool = VkExecutePool(self.execute, delay=0.01)
+
+        results = [pool.call('users.get', {'user_ids': i})
+                   for i in range(1, 31)]
+
+        self.assertListEqual([r.result(timeout=1)[0]['id'] for r in results],
+                             list(range(1, 31)))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_failed_call_does_not_affect_others(self):
+        pool = VkExecutePool(self.execute, delay=0.01)
+
+        ok = pool.call('users.get', {'user_ids': 1})
+        failed = pool.call('users.get', {'user_ids': -1})
+
+        self.assertEqual(ok.result(timeout=1)[0]['id'], 1)
+        with self.assertRaises(VkExecuteError) as cm:
+            failed.result(timeout=1)
+        self.assertEqual(cm.exception.error['error_code'], 113)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_execute_all_in_one_thread(self):
+        calls = [('users.get', {'user_ids': i}) for i in [*range(1, 30), -1]]
+
+        results = VkExecutePool.execute_all(self.execute, calls)
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertListEqual([r[0]['id'] for r in results[:-1]],
+                             list(range(1, 30)))
+        self.assertIsInstance(results[-1], VkExecuteError)
+
+
+class FakeTagFinder(TagFinder):
+    """
+    TagFinder с провайдерами-заглушками: для каждого провайдера задаются
+    ответ, время ответа и время ожидания разрешения на запрос.
+    """
+    @classmethod
+    def create(cls, answers, timeouts=None):
+        # в обход Singleton и подключения к настоящим провайдерам
+        finder = object.__new__(cls)
+        finder._cache = None
+        finder._executor = futures.ThreadPoolExecutor(max_workers=3)
+        finder._timeouts = timeouts or {}
+        finder._answers = answers
+        finder.acquired = []
+        return finder
+
+    def _acquire(self, provider):
+        self.acquired.append(provider)
+        time.sleep(self._answers[provider].get('token', 0))
+
+    def _answer(self, provider):
+        answer = self._answers[provider]
+        time.sleep(answer.get('delay', 0))
+        return answer.get('genre')
+
+    def _discogs(self, artist, track):
+        return self._answer('discogs')
+
+    def _musicbrainz(self, artist, track):
+        return self._answer('musicbrainz')
+
+    def _google(self, artist, track):
+        return self._answer('google')
+
+
+class TagFinderConcurrentTest(SimpleTestCase):
+    def test_priority_order(self):
+        finder = FakeTagFinder.create({'discogs': {},
+                                       'musicbrainz': {'genre': 'jazz',
+                                                       'delay': 0.2},
+                                       'google': {'genre': 'rock'}})
+
+        self.assertTupleEqual(finder.lookup('artist', 'track'),
+                              ('jazz', 'musicbrainz'))
+
+    def test_returns_without_waiting_for_slower_providers(self):
+        finder = FakeTagFinder.create({'discogs': {'genre': 'rock'},
+                                       'musicbrainz': {'token': 1},
+                                       'google': {'token': 1}})
+
+        start = time.time()
+        self.assertTupleEqual(finder.lookup('artist', 'track'),
+                              ('rock', 'discogs'))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout_starts_after_token(self):
+        finder = FakeTagFinder.create(
+            {'discogs': {'genre': 'rock', 'token': 0.3, 'delay': 0.1},
+             'musicbrainz': {}, 'google': {}},
+            timeouts={'discogs': 0.2})
+
+        self.assertTupleEqual(finder.lookup('artist', 'track'),
+                              ('rock', 'discogs'))
+
+    def test_timeout(self):
+        finder = FakeTagFinder.create(
+            {'discogs': {'genre': 'rock', 'delay': 0.5},
+             'musicbrainz': {}, 'google': {}},
+            timeouts={'discogs': 0.1})
+
+        with self.assertRaises(ProviderTimeout):
+            finder.lookup('artist', 'track')
+
+
+class VkApiTest(SimpleTestCase):
+    def setUp(self):
+        # экземпляр без авторизации в vk, запросы к api подменяются
+        self.api = object.__new__(VkApi)
+        self.api._batch_methods = set()
+        self.api._request = self.request
+
+    @staticmethod
+    def request(method, params):
+        return [{'id': int(i), 'first_name': 'Walter', 'last_name': str(i)}
+                for i in params['user_ids'].split(',')]
+
+    def test_username_accepts_string_id(self):
+        self.assertEqual(self.api.username('1'), 'Walter 1')
+        self.assertEqual(self.api.username(1), 'Walter 1')
+
+    def test_usernames(self):
+        self.assertDictEqual(self.api.usernames([1, 2]),
+                             {1: 'Walter 1', 2: 'Walter 2'})
@@ -8,5 +8,16 @@ app_name = 'vk_audio_stats'
 urlpatterns = [
     path('', views.index, name='index'),
     path('genre/', views.genre, name='genre'),
-    path('user/<int:vk_id>', views.UserView.as_view(), name='user')
+    path('genre/export.<str:export_format>', views.genre_export,
+         name='genre_export'),
+    path('user/<int:vk_id>', views.UserView.as_view(), name='user'),
+    path('user/<int:vk_id>/progress', views.user_progress,
+         name='user_progress'),
+    path('user/<int:vk_id>/similar', views.user_similar, name='user_similar'),
+    path('user/<int:vk_id>/recommendations', views.user_recommendations,
+         name='user_recommendations'),
+    path('user/<int:vk_id>/charts/<str:name>', views.user_chart_json,
+         name='user_chart'),
+    path('user/<int:vk_id>/friends/<int:friend_vk_id>/chart',
+         views.friend_chart_json, name='friend_chart'),
 ]
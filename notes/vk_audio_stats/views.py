@@ -1,28 +1,84 @@
+import csv
 import functools
+import hashlib
+import itertools
+import json
 import math
-import operator
 
-from django.db.models import Count, Q
-from django.http import HttpResponse, HttpResponseRedirect
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         JsonResponse, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.views import generic
 
 import pandas as pd
 import redis
 
 from bokeh.core.properties import value
-from bokeh.embed import components
+from bokeh.embed import components, json_item
 from bokeh.models import ColumnDataSource
 from bokeh.palettes import viridis, Spectral6
 from bokeh.plotting import figure
 from bokeh.transform import cumsum, dodge, factor_cmap
 
-from .models import Artist, Genre, Track, VkUser
-from .tasks import db_update_user
+from . import progress, recommendations, similarity
+from .compatibility import GenreMatrix
+from .models import Artist, Genre, Track, UserGenreStats, VkUser
+from .tasks import (GENRE_LOOKUP_PENDING_KEY, GENRE_STATS_VERSION_KEY,
+                    get_genre_cache, recommendations_rebuild_matrix,
+                    start_user_refresh)
 
 
-def genre_chart(title, genre_count, large=False):
+def cached_chart(func):
+    """
+    Кеширует построенный график по хешу имени функции и всех её
+    аргументов, так что при неизменных данных bokeh не вызывается.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        params = json.dumps([func.__name__, args, kwargs], default=str)
+        key = f'chart {hashlib.sha1(params.encode()).hexdigest()}'
+
+        chart_cache = caches[settings.CHART_CACHE]
+        chart = chart_cache.get(key)
+        if chart is None:
+            chart = func(*args, **kwargs)
+            chart_cache.set(key, chart)
+
+        return chart
+
+    return wrapper
+
+
+def embed(p, as_json=False):
+    if as_json:
+        return json_item(p)
+
+    script, div = components(p)
+
+    return {'script': script, 'div': div}
+
+
+def top_n(counts, n, other='другие'):
+    """n - 1 наибольших значений словаря, остальные суммируются в other."""
+    items = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+    if len(items) <= n:
+        return dict(items)
+
+    result = dict(items[:n - 1])
+    result[other] = sum(v for _, v in items[n - 1:])
+
+    return result
+
+
+@cached_chart
+def genre_chart(title, genre_count, large=False, as_json=False):
+    genre_count = top_n(genre_count, settings.CHART_TOP_GENRES)
+
     data = pd.Series(genre_count).reset_index(name='value').rename(
         columns={'index': 'genre'})
     data['angle'] = data['value'] / data['value'].sum() * 2 * math.pi
@@ -42,12 +98,16 @@ def genre_chart(title, genre_count, large=False):
     p.axis.visible = False
     p.grid.grid_line_color = None
 
-    script, div = components(p)
+    return embed(p, as_json)
 
-    return {'script': script, 'div': div}
 
+@cached_chart
+def friends_common_genre_chart(title, common_genre_list, as_json=False):
+    common_genre_list = dict(sorted(
+        common_genre_list.items(),
+        key=lambda x: sum(count for _, count in x[1]),
+        reverse=True)[:settings.CHART_TOP_GENRES])
 
-def friends_common_genre_chart(title, common_genre_list):
     users = [u[0] for u in common_genre_list[list(common_genre_list.keys())[0]]]
 
     data = {g: [u[1] for u in items] for g, items in common_genre_list.items()}
@@ -75,21 +135,35 @@ def friends_common_genre_chart(title, common_genre_list):
     p.legend.location = 'top_left'
     p.legend.orientation = 'horizontal'
 
-    script, div = components(p)
+    return embed(p, as_json)
 
-    return {'script': script, 'div': div}
 
+@cached_chart
+def compatibility_chart(title, compatibility, track_overlap=None,
+                        as_json=False):
+    compatibility = dict(sorted(
+        compatibility.items(), key=lambda x: x[1],
+        reverse=True)[:settings.CHART_TOP_FRIENDS])
 
-def compatibility_chart(title, compatibility):
     users = list(compatibility.keys())
-    source = ColumnDataSource(
-        data=dict(users=users, compatibility=list(compatibility.values())))
+    data = dict(users=users, compatibility=list(compatibility.values()))
+    tooltips = [('совместимость', '@compatibility')]
+
+    # оценка общих треков по скетчам: (коэффициент Жаккара, общих треков)
+    if track_overlap:
+        overlap = [track_overlap.get(u, (0.0, 0)) for u in users]
+        data['jaccard'] = [round(j, 2) for j, _ in overlap]
+        data['shared_tracks'] = [n for _, n in overlap]
+        tooltips.extend([('общих треков (оценка)', '@shared_tracks'),
+                         ('коэффициент Жаккара', '@jaccard')])
+
+    source = ColumnDataSource(data=data)
 
     y_max = max(compatibility.values()) + 0.1 * max(compatibility.values())
 
     p = figure(x_range=users, y_range=(0, y_max), plot_height=300,
                toolbar_location=None, title=title, tools='hover',
-               tooltips=[('совместимость', '@compatibility')])
+               tooltips=tooltips)
     p.vbar(x='users', top='compatibility', width=0.9, source=source,
            legend='users', line_color='white',
            fill_color=factor_cmap('users', palette=Spectral6, factors=users))
@@ -98,9 +172,7 @@ def compatibility_chart(title, compatibility):
     p.legend.orientation = 'horizontal'
     p.legend.location = 'top_center'
 
-    script, div = components(p)
-
-    return {'script': script, 'div': div}
+    return embed(p, as_json)
 
 
 def index(request):
@@ -109,7 +181,8 @@ def index(request):
     user_count = VkUser.objects.all().count
 
     if request.method == 'POST':
-        db_update_user.delay(request.POST.get('vk_user_id_to_update'))
+        start_user_refresh(request.POST.get('vk_user_id_to_update'),
+                           interactive=True)
 
         return HttpResponseRedirect(
             reverse('vk_audio_stats:user',
@@ -118,49 +191,259 @@ def index(request):
     return render(request, 'vk_audio_stats/index.html',
                   {'artist_count': artist_count,
                    'track_count': track_count,
-                   'user_count': user_count})
+                   'user_count': user_count,
+                   'genre_cache_stats': get_genre_cache().stats()})
 
 
-def genre(request):
-    genre_list = [
-        t.genre for t in Track.objects
-        .filter(vkuser__isnull=False, genre__isnull=False)
-        .distinct('genre')
-    ]
-
-    genre_user_count = {
-        g[0]: g[1] for g in Track.objects
-        .filter(vkuser__isnull=False, genre__isnull=False)
-        .values_list('genre__name')
-        .annotate(Count('vkuser__name'))
-    }
+def genre_stats():
+    """
+    Жанры с количеством пользователей, у которых есть треки этого жанра.
+    Считается одним запросом по статистике жанров пользователей и кешируется
+    до следующего изменения статистики (см. tasks.genre_stats_changed).
+    """
+    version = int(redis.Redis().get(GENRE_STATS_VERSION_KEY) or 0)
+    cache_key = f'genre stats {version}'
 
-    chart = genre_chart('Users for genre', genre_user_count, large=True)
+    cache = caches['default']
+    genre_list = cache.get(cache_key)
+    if genre_list is None:
+        genre_list = list(
+            Genre.objects.filter(usergenrestats__count__gt=0)
+            .annotate(user_count=Count('usergenrestats'))
+            .order_by('name'))
+        cache.set(cache_key, genre_list, settings.GENRE_STATS_CACHE_TTL)
+
+    return genre_list
+
+
+def genre_id_list(request):
+    return [int(g) for g in request.GET.getlist('genre') if g.isdigit()]
 
-    # пользователи по выбранным жанрам
-    genre_id_list = request.GET.getlist('genre')
 
-    user_list = {}
-    if genre_id_list:
-        condition = functools.reduce(
-            operator.or_,
-            [Q(genre__id=int(genre_id)) for genre_id in genre_id_list])
+def genre_users(genre_ids, after=0, limit=None):
+    """
+    Страница пользователей с треками выбранных жанров: не больше limit
+    пользователей по возрастанию id, начиная после пользователя с id after.
+    Для каждого возвращается (id, vk_id, имя, {жанр: количество треков}).
+    """
+    stats = UserGenreStats.objects.filter(genre_id__in=genre_ids, count__gt=0)
 
-        q = (Track.objects.filter(condition)
-             .values_list('vkuser__name', 'genre__name')
-             .annotate(Count('vkuser__name')))
+    user_ids = list(stats.filter(user_id__gt=after)
+                    .values_list('user_id', flat=True)
+                    .order_by('user_id').distinct()[:limit])
 
-        for name, genre, count in q:
-            if name not in user_list:
-                user_list[name] = {}
+    rows = (stats.filter(user_id__in=user_ids)
+            .values_list('user_id', 'user__vk_id', 'user__name',
+                         'genre__name', 'count')
+            .order_by('user_id', 'genre__name'))
 
-            user_list[name][genre.title()] = count
+    return [(user_id, vk_id, name, {r[3].title(): r[4] for r in group})
+            for (user_id, vk_id, name), group in itertools.groupby(
+                rows, key=lambda r: r[:3])]
+
+
+def genre_users_page(genre_ids, after, page_size):
+    """
+    Страница genre_users и строка запроса следующей страницы, None - если
+    страница последняя. Загружается на одного пользователя больше, чтобы
+    не ссылаться на пустую страницу.
+    """
+    user_list = genre_users(genre_ids, after, page_size + 1)
+    if len(user_list) <= page_size:
+        return user_list, None
+
+    user_list = user_list[:page_size]
+    next_page = urlencode([('genre', g) for g in genre_ids]
+                          + [('after', user_list[-1][0])])
+
+    return user_list, next_page
+
+
+def iter_genre_users(genre_ids, page_size):
+    """Все пользователи выбранных жанров, загружаемые страницами."""
+    after = 0
+    while True:
+        page = genre_users(genre_ids, after, page_size)
+        yield from page
+
+        if len(page) < page_size:
+            return
+        after = page[-1][0]
+
+
+def genre(request):
+    genre_list = genre_stats()
+
+    genre_user_count = {g.name: g.user_count for g in genre_list}
+
+    chart = genre_chart('Users for genre', genre_user_count, large=True)
+
+    # пользователи по выбранным жанрам, постранично по id пользователя
+    genre_ids = genre_id_list(request)
+    after = request.GET.get('after', '')
+    after = int(after) if after.isdigit() else 0
+
+    user_list = []
+    next_page = None
+    if genre_ids:
+        user_list, next_page = genre_users_page(
+            genre_ids, after, settings.GENRE_USERS_PAGE_SIZE)
 
     return render(request, 'vk_audio_stats/genre_list.html',
                   {'genre_list': genre_list,
-                   'checked_genre_list': [int(g) for g in genre_id_list],
+                   'checked_genre_list': genre_ids,
                    'chart': chart,
-                   'user_list': user_list})
+                   'user_list': user_list,
+                   'next_page': next_page,
+                   'export_query': urlencode([('genre', g)
+                                              for g in genre_ids])})
+
+
+class Echo:
+    """Файлоподобный объект для csv.writer, возвращающий записанную строку."""
+    def write(self, value):
+        return value
+
+
+def genre_export(request, export_format):
+    """Потоковая выгрузка всех пользователей выбранных жанров."""
+    users = iter_genre_users(genre_id_list(request),
+                             settings.GENRE_EXPORT_PAGE_SIZE)
+
+    if export_format == 'csv':
+        writer = csv.writer(Echo())
+        rows = itertools.chain(
+            [writer.writerow(['vk_id', 'name', 'genre', 'count'])],
+            (writer.writerow([vk_id, name, genre, count])
+             for _, vk_id, name, genres in users
+             for genre, count in genres.items()))
+        content_type = 'text/csv'
+    elif export_format == 'ndjson':
+        rows = (json.dumps({'vk_id': vk_id, 'name': name, 'genres': genres},
+                           ensure_ascii=False) + '\n'
+                for _, vk_id, name, genres in users)
+        content_type = 'application/x-ndjson'
+    else:
+        raise Http404(f'Неизвестный формат {export_format}')
+
+    response = StreamingHttpResponse(rows,
+                                     content_type=f'{content_type}; '
+                                                  f'charset=utf-8')
+    response['Content-Disposition'] = (f'attachment; '
+                                       f'filename="users.{export_format}"')
+
+    return response
+
+
+def query_count(request, name, default, maximum):
+    """
+    Целый параметр запроса от 1 до maximum, default - если параметр не
+    задан или некорректен.
+    """
+    value = request.GET.get(name, '')
+    if not value.isdigit() or int(value) < 1:
+        return default
+
+    return min(int(value), maximum)
+
+
+def similar_users(user, k=10):
+    scores = similarity.most_similar(user.id, k)
+    users = VkUser.objects.in_bulk([user_id for user_id, _ in scores])
+
+    return [(users[user_id], score) for user_id, score in scores
+            if user_id in users]
+
+
+def user_similar(request, vk_id):
+    user = get_object_or_404(VkUser, vk_id=vk_id)
+    k = query_count(request, 'k', 10, 100)
+
+    return JsonResponse({
+        'vk_id': user.vk_id,
+        'similar': [{'vk_id': u.vk_id, 'name': u.name,
+                     'similarity': round(score, 3)}
+                    for u, score in similar_users(user, k)]
+    })
+
+
+def user_recommendations(request, vk_id):
+    user = get_object_or_404(VkUser, vk_id=vk_id)
+    k = query_count(request, 'k', 50, 200)
+
+    result = recommendations.recommend(
+        user, k, settings.RECOMMENDATIONS_CACHE_TTL)
+    if result is None and recommendations.claim_rebuild():
+        recommendations_rebuild_matrix.delay()
+
+    return JsonResponse({'vk_id': user.vk_id,
+                         'ready': result is not None,
+                         'recommendations': result or []})
+
+
+def user_chart(user, name, matrix, as_json=False):
+    """График страницы пользователя по имени, None - если данных нет."""
+    if name == 'genres':
+        return genre_chart(f'Жанры пользователя {user.name}',
+                           matrix.user_genres(), as_json=as_json)
+
+    if name == 'common':
+        common_for_all = matrix.common_for_all()
+        if not common_for_all:
+            return None
+        return friends_common_genre_chart(
+            'Общие со всеми друзьями жанры', common_for_all, as_json=as_json)
+
+    if name == 'compatibility':
+        compatibility = matrix.compatibility()
+        if not compatibility:
+            return None
+        return compatibility_chart(
+            'Музыкальная совместимость с друзьями', compatibility,
+            matrix.track_overlap(), as_json=as_json)
+
+    raise Http404(f'Неизвестный график {name}')
+
+
+def user_chart_json(request, vk_id, name):
+    user = get_object_or_404(VkUser, vk_id=vk_id)
+
+    chart = user_chart(user, name, GenreMatrix.load(user, user.friends.all()),
+                       as_json=True)
+    if chart is None:
+        raise Http404('Нет данных для графика')
+
+    return JsonResponse(chart)
+
+
+def friend_chart_json(request, vk_id, friend_vk_id):
+    user = get_object_or_404(VkUser, vk_id=vk_id)
+    friend = get_object_or_404(user.friends, vk_id=friend_vk_id)
+
+    common = GenreMatrix.load(user, [friend]).common()
+    if not common:
+        raise Http404('Нет общих жанров')
+
+    return JsonResponse(genre_chart(
+        f'Общие жанры с пользователем {friend.name}',
+        next(iter(common.values())), as_json=True))
+
+
+def user_progress(request, vk_id):
+    """
+    Long-poll ход обновления пользователя: ответ приходит, как только
+    версия хода станет больше переданной в version, или по таймауту.
+    """
+    version = request.GET.get('version', '')
+    version = int(version) if version.isdigit() else 0
+
+    result = progress.wait(vk_id, version,
+                           settings.UPDATE_PROGRESS_POLL_TIMEOUT)
+    # поиск жанров общий для всех обновлений, поэтому показывается размер
+    # общей очереди
+    result['genres_pending'] = redis.Redis().scard(GENRE_LOOKUP_PENDING_KEY)
+
+    return JsonResponse(result)
 
 
 class UserView(generic.DetailView):
@@ -186,61 +469,18 @@ class UserView(generic.DetailView):
         if not context['update_state']:
             return context
 
-        user_friends = user.friends.all()
-
-        user_genres = {
-            x[0]: x[1] for x in
-            (user.tracks.filter(genre__isnull=False).values_list('genre__name')
-             .annotate(Count('genre')))
-        }
-
-        context['user_genre_chart'] = genre_chart(
-            f'Жанры пользователя {user.name}', user_genres)
-
-        condition = ((Q(vkuser__in=user_friends) | Q(vkuser=user)) &
-                     Q(genre__isnull=False))
-        tracks = (Track.objects.filter(condition)
-                  .values_list('genre__name', 'vkuser__name')
-                  .annotate(Count('genre')))
-        group_by_genre = {x[0]: [] for x in tracks}
-        [group_by_genre[x[0]].append((x[1], x[2])) for x in tracks]
-
-        common_for_all = {g: sorted(u, key=lambda x: x[0])
-                          for g, u in group_by_genre.items()
-                          if len(u) == len(user_friends) + 1}
-
-        if common_for_all:
-            context['all_friends_common_genre'] = friends_common_genre_chart(
-                'Общие со всеми друзьями жанры', common_for_all)
-
-        friends_genres = {
-            u.name: {
-                x[0]: x[1] for x in
-                u.tracks.filter(genre__name__in=user_genres)
-                        .values_list('genre__name').annotate(Count('genre'))
-            } for u in user_friends
-        }
-
-        common = {
-            user_name: {
-                name: min(genre_list[name], user_genres[name])
-                for name in genre_list
-            } for user_name, genre_list in friends_genres.items() if genre_list
-        }
-
-        context['friend_common_genre_list'] = {
-            name: genre_chart(f'Общие жанры с пользователем {name}', genre_list)
-            for name, genre_list in common.items()
-        }
-
-        compatibility = {
-            name: (100 * sum(genres.values()) /
-                   max(user.tracks.count(),
-                       user.friends.get(name=name).tracks.count()))
-            for name, genres in common.items()
-        }
-
-        context['friends_compatibility'] = compatibility_chart(
-            'Музыкальная совместимость с друзьями', compatibility)
+        matrix = GenreMatrix.load(user, user.friends.all())
+
+        context['user_genre_chart'] = user_chart(user, 'genres', matrix)
+        context['all_friends_common_genre'] = user_chart(user, 'common',
+                                                         matrix)
+        context['friends_compatibility'] = user_chart(user, 'compatibility',
+                                                      matrix)
+
+        # графики общих жанров с друзьями загружаются страницей по мере
+        # прокрутки
+        context['friends_with_common_genres'] = matrix.friends_with_common()
+
+        context['similar_users'] = similar_users(user)
 
         return context